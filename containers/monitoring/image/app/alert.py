@@ -1,6 +1,9 @@
 # add information from the FMP to the EOP result
+import numpy as np
+import pandas as pd
 import geopandas as gpd
-import copy
+
+import intersect
 
 '''
 casistiche incluse:
@@ -11,19 +14,56 @@ casistiche incluse:
 
 # fieldnames FMP point
 
-def add_alert_info(path_fmp, path_eop_result, path_out_alert):
+# FMP info of every EOP intersecting an FMP point (pratiche sotto soglia, AREA_DECLARED)
+# or polygon (altre pratiche, AREA_PROJECT_INTERSECT). Returns a DataFrame indexed by ID_EOP
+def get_fmp_intersect(fmp_point, fmp_polygon):
+    fmp_point = pd.DataFrame({
+        'ID_EOP': fmp_point['ID_EOP'],
+        'ID_FMP': fmp_point['ID_FMP'] + ',',
+        'AREA_TOT_DECLARED': fmp_point['AREA_DECLARED'],
+        'AREA_TOT_INTERSECT': 0.0,
+        'AMM_POINT': True,
+        'AMM_POLYGON': False,
+    })
+    fmp_polygon = pd.DataFrame({
+        'ID_EOP': fmp_polygon['ID_EOP'],
+        'ID_FMP': fmp_polygon['ID_FMP'] + ',',
+        'AREA_TOT_DECLARED': 0.0,
+        'AREA_TOT_INTERSECT': fmp_polygon['AREA_PROJECT_INTERSECT'],
+        'AMM_POINT': False,
+        'AMM_POLYGON': True,
+    })
+    # points first: ID_FMP lists the points, then the polygons
+    fmp_intersect = pd.concat([fmp_point, fmp_polygon], ignore_index=True).groupby('ID_EOP', sort=False).agg({
+        'ID_FMP': ''.join,
+        'AREA_TOT_DECLARED': 'sum',
+        'AREA_TOT_INTERSECT': 'sum',
+        'AMM_POINT': 'any',
+        'AMM_POLYGON': 'any',
+    })
+    fmp_intersect['AREA_TOT_REQUESTED'] = fmp_intersect['AREA_TOT_INTERSECT'] + fmp_intersect['AREA_TOT_DECLARED']
+    # 1: pratiche sotto soglia, 2: altre pratiche, 3: mix pratiche (tipo 1 e 2)
+    fmp_intersect['AMM_TYPE'] = fmp_intersect['AMM_POINT'] * 1 + fmp_intersect['AMM_POLYGON'] * 2
+    return fmp_intersect[['ID_FMP', 'AREA_TOT_DECLARED', 'AREA_TOT_INTERSECT', 'AREA_TOT_REQUESTED', 'AMM_TYPE']]
+
+
+# Alert code of the EOP
+# 0: difference between EOP and authorized cut area is less than 1000 m2 or 5% of the authorized cut area
+# 1: difference between EOP and authorized cut area is more than 1000 m2 and 5% of the authorized cut area
+# 2: difference between EOP and authorized cut area is more than 10000 m2 and 20% of the authorized cut area
+# 3: no authorization for the cut
+def get_alert_code(area_eop, area_requested, amm_type):
+    area_diff = area_eop - area_requested
+    code0 = (area_diff < 1000) | (area_diff < (0.05 * area_eop))
+    code1 = ((area_diff >= 1000) | (area_diff >= (0.05 * area_eop))) & ((area_diff < 10000) | (area_diff < (0.20 * area_eop)))
+    return np.select([amm_type == 0, code0, code1], [3, 0, 1], default=2)
+
+
+def add_alert_info(path_fmp, path_eop_result, path_out_alert, pool=None):
     '''
     input and output geojson are in epsg 3035
+    pool: executor of the FMP/EOP intersections (None: computed in this process)
     '''
-    dict_fmp_intersect = {}
-    record_intersection = {
-        'ID_FMP': '',
-        'AREA_TOT_DECLARED': 0.0,
-        'AREA_TOT_INTERSECT': 0.0,
-        'AREA_TOT_REQUESTED': 0.0,
-        'AMM_TYPE': 0,  # 0: no amm, 1: pratiche sotto soglia, 2: altre pratiche, 3: mix pratiche (tipo 1 e 2)
-    }
-
     # LOAD FMP DATA
     fmp_data = gpd.read_file(path_fmp)
 
@@ -70,85 +110,30 @@ def add_alert_info(path_fmp, path_eop_result, path_out_alert):
     fmp_point = gpd.sjoin(fmp_point, eop_in, how='inner', predicate='intersects')
 
     # INTERSECTION: only the FMP polygons that intersect with the EOP
-    fmp_polygon = gpd.overlay(fmp_polygon,eop_in)
-    fmp_polygon['AREA_PROJECT_INTERSECT'] = fmp_polygon.area
-
-    # CONVERT TO DICT
-    fmp_point3 = fmp_point.to_dict(orient='records')
-    fmp_polygon3 = fmp_polygon.to_dict(orient='records')
-
-    # CREATE EMPTY COLUMNS IN EOP
-    eop_in['ID_FMP'] = ''
-    eop_in['AREA_TOT_DECLARED'] = 0.0
-    eop_in['AREA_TOT_INTERSECT'] = 0.0
-    eop_in['AREA_TOT_REQUESTED'] =  0.0
-    eop_in['AMM_TYPE'] = 0  # 0: no amm, 1: pratiche sotto soglia, 2: altre pratiche, 3: mix pratiche (tipo 1 e 2)
-    eop_in['ALERT'] = 0  # 0: no amm, 1: pratiche sotto soglia, 2: altre pratiche, 3: mix pratiche (tipo 1 e 2)
-
-
-    # UNION OF FMP POLYGONS AND POINTS
-    # get intersect info from fmp points
-    for pt1 in fmp_point3:
-        id_eop = pt1['ID_EOP']
-        id_fmp = pt1['ID_FMP']
-        if not id_eop in dict_fmp_intersect:
-            dict_fmp_intersect[id_eop] = copy.deepcopy(record_intersection)
-        dict_fmp_intersect[id_eop]['ID_FMP'] += id_fmp + ','
-        dict_fmp_intersect[id_eop]['AREA_TOT_DECLARED'] += pt1['AREA_DECLARED']
-        match(dict_fmp_intersect[id_eop]['AMM_TYPE']):
-            case 0:
-                dict_fmp_intersect[id_eop]['AMM_TYPE'] = 1
-            case 2:
-                dict_fmp_intersect[id_eop]['AMM_TYPE'] = 3
-            case _:
-                pass
-    for pol1 in fmp_polygon3:
-        id_eop = pol1['ID_EOP']
-        id_fmp = pol1['ID_FMP']
-        if not id_eop in dict_fmp_intersect:
-            dict_fmp_intersect[id_eop] = copy.deepcopy(record_intersection)
-        dict_fmp_intersect[id_eop]['ID_FMP'] += id_fmp + ','
-        dict_fmp_intersect[id_eop]['AREA_TOT_INTERSECT'] += pol1['AREA_PROJECT_INTERSECT']
-        match(dict_fmp_intersect[id_eop]['AMM_TYPE']):
-            case 0:
-                dict_fmp_intersect[id_eop]['AMM_TYPE'] = 2
-            case 1:
-                dict_fmp_intersect[id_eop]['AMM_TYPE'] = 3
-            case _:
-                pass
-
-    # CLEAN UP AND COMPUTE TOTAL REQUESTED AREA
-        dict_fmp_intersect[key]['AREA_TOT_REQUESTED'] = dict_fmp_intersect[key]['AREA_TOT_INTERSECT'] + dict_fmp_intersect[key]['AREA_TOT_DECLARED']
+    # (candidate pairs from the spatial index, then the exact intersection of each pair)
+    pairs = intersect.intersection_pairs(fmp_polygon, eop_in, pool=pool)
+    fmp_polygon = pd.DataFrame({
+        'ID_FMP': fmp_polygon['ID_FMP'].values[pairs['ix_left']],
+        'ID_EOP': eop_in['ID_EOP'].values[pairs['ix_right']],
+        'AREA_PROJECT_INTERSECT': pairs['area'].values,
+    })
+
+    # AGGREGATE FMP INFO BY EOP
+    fmp_intersect = get_fmp_intersect(fmp_point, fmp_polygon)
 
     # ADD INFO TO EOP
-    for key in dict_fmp_intersect:
-        eop_in.loc[eop_in['ID_EOP'] == key, 'ID_FMP'] = dict_fmp_intersect[key]['ID_FMP']
-        eop_in.loc[eop_in['ID_EOP'] == key, 'AREA_TOT_DECLARED'] = dict_fmp_intersect[key]['AREA_TOT_DECLARED']
-        eop_in.loc[eop_in['ID_EOP'] == key, 'AREA_TOT_INTERSECT'] = dict_fmp_intersect[key]['AREA_TOT_INTERSECT']
-        eop_in.loc[eop_in['ID_EOP'] == key, 'AREA_TOT_REQUESTED'] = dict_fmp_intersect[key]['AREA_TOT_REQUESTED']
-        eop_in.loc[eop_in['ID_EOP'] == key, 'AMM_TYPE'] = dict_fmp_intersect[key]['AMM_TYPE']
-
-        area_eop = eop_in.loc[eop_in['ID_EOP'] == key, 'AREA_EOP'].iloc[0]
-        area_diff = area_eop - dict_fmp_intersect[key]['AREA_TOT_REQUESTED']
-        # ADD ALERT INFO TO EOP
-        # 0: difference between EOP and authorized cut area is less than 1000 m2 or 5% of the authorized cut area
-        # 1: difference between EOP and authorized cut area is more than 1000 m2 and 5% of the authorized cut area
-        # 2: no authorization for the cut
-        #if dict_fmp_intersect[key]['AMM_TYPE'] > 0:
-
-        # in this loop every record has an authorization
-        # code 0: no alert
-        if area_diff < 1000 or area_diff < (0.05 * area_eop):
-            eop_in.loc[eop_in['ID_EOP'] == key, 'ALERT'] = 0
-        # code 1: low alert
-        elif (area_diff >= 1000 or area_diff >= (0.05 * area_eop)) and (area_diff < 10000 or area_diff < (0.20 * area_eop)):
-            eop_in.loc[eop_in['ID_EOP'] == key, 'ALERT'] = 1
-        # code 2: intermediate alert
-        else:
-            eop_in.loc[eop_in['ID_EOP'] == key, 'ALERT'] = 2
-
-    # code 2: intermediate alert; there is no authorization
-    eop_in.loc[eop_in['AMM_TYPE'] == 0, 'ALERT'] = 3
+    eop_in = eop_in.merge(fmp_intersect, how='left', left_on='ID_EOP', right_index=True)
+    eop_in = eop_in.fillna({
+        'ID_FMP': '',
+        'AREA_TOT_DECLARED': 0.0,
+        'AREA_TOT_INTERSECT': 0.0,
+        'AREA_TOT_REQUESTED': 0.0,
+        'AMM_TYPE': 0,  # 0: no amm, 1: pratiche sotto soglia, 2: altre pratiche, 3: mix pratiche (tipo 1 e 2)
+    })
+    eop_in['AMM_TYPE'] = eop_in['AMM_TYPE'].astype(int)
+
+    # ADD ALERT INFO TO EOP
+    eop_in['ALERT'] = get_alert_code(eop_in['AREA_EOP'], eop_in['AREA_TOT_REQUESTED'], eop_in['AMM_TYPE'])
 
     # SAVE EOP ALERT
     eop_in.to_file(
@@ -1,4 +1,3 @@
-import os
 import sys
 import traceback
 
@@ -7,17 +6,18 @@ from datetime import datetime
 from waitress import serve
 
 import mon
+import jobs
 import logging
 
-logger = None
-
 VERSION = 201
 app = Flask(__name__)
 
 # TODO x versione 3, da discutere con Almaviva: inserire nei requisiti la maschera bosco?
 
 
-def create_logger(mon_input, level=logging.INFO):
+def create_logger(mon_input, level=logging.INFO, name='mon_logger'):
+    """logger (one for each job process) writing to the log file of a request: the handler
+    of the previous request is replaced. Returns the logger and its handler"""
     data_rif = mon_input['data_rif']
     date_start = mon_input['data_ini_mon']
     date_end = mon_input['data_fin_mon']
@@ -27,11 +27,14 @@ def create_logger(mon_input, level=logging.INFO):
     handler = logging.FileHandler(log_path)
     handler.setFormatter(logging.Formatter(log_format))
 
-    bin_logger = logging.getLogger('mon_logger')
+    bin_logger = logging.getLogger(name)
     bin_logger.setLevel(level)
+    for old_handler in list(bin_logger.handlers):
+        bin_logger.removeHandler(old_handler)
+        old_handler.close()
     bin_logger.addHandler(handler)
 
-    return bin_logger
+    return bin_logger, handler
 
 
 
@@ -48,24 +51,12 @@ def ping():
     return jsonify(result)
 
 
-@app.route('/monitor', methods=['GET', 'POST'])
-def monitor():
+def run_monitor(job):
+    "run the monitoring of a job (jobs.JobQueue): returns the response of /monitor"
     status = 1
-    path_err_log = '../data/mon_error_backtrace.txt'
-    if os.path.exists(path_err_log):
-        os.remove(path_err_log)
-
     err_desc = ""
-    content = request.json
-    if not content:
-        raise Exception("No JSON content received")
-
-    # -- define monitoring parameters --------------------------------------------
-    mon_input = dict(content)
-    global logger
-    logger = create_logger(mon_input)
-    if not logger:
-        raise Exception("Error creating logger")
+    mon_input = dict(job.input)
+    job_logger, handler = create_logger(mon_input)
 
     result = {
             'api_version': VERSION,
@@ -83,16 +74,19 @@ def monitor():
         result['data']['start_date'] = timestamp
 
         # -- lauch monitoring app & update response ----------------------------------
-        status = mon.main(mon_input, logger)
+        status = mon.main(mon_input, job_logger, dir_tmp=job.dir)
 
     except Exception as e:
         print('Error in monitor')
-        logger.error(repr(e))
+        job_logger.error(repr(e))
         exc_type, exc_value, exc_traceback = sys.exc_info()
         desc = repr(traceback.extract_tb(exc_traceback))
         err_desc = repr(e) + '\n' + desc
-        with open(path_err_log, 'w') as err_log:
-            traceback.print_exc(file=err_log)
+        # the backtrace is returned in the result (deserr) and saved in the request log
+        job_logger.error(traceback.format_exc())
+    finally:
+        job_logger.removeHandler(handler)
+        handler.close()
 
     if not status:
         result['isOK'] = True
@@ -105,10 +99,81 @@ def monitor():
         now = datetime.now()
         timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
         result['data']['end_date'] = timestamp
-    return jsonify(result)
+    return result
+
+
+job_queue = jobs.JobQueue(run_monitor)
+
+
+def get_job_response(data=None, coderr=0, deserr=""):
+    return {
+            'api_version': VERSION,
+            'isOK': coderr == 0,
+            'data': data or dict(),
+            'error': {
+                'coderr': coderr,
+                'deserr': deserr
+                }
+            }
+
+
+@app.route('/monitor', methods=['GET', 'POST'])
+def monitor():
+    content = request.json
+    if not content:
+        raise Exception("No JSON content received")
+
+    # the request runs in the job queue (isolated temporary directory) and waits for
+    # the end of the job
+    job_id = job_queue.submit(dict(content))
+    job = job_queue.wait(job_id)
+    if job.status == jobs.JOB_FAILED:
+        # the job did not return its response (e.g. job process killed): same error
+        # response of a failed monitoring
+        data = {
+                'start_date': (job.started or job.submitted).strftime("%Y-%m-%d %H:%M:%S"),
+                'end_date': (job.ended or datetime.now()).strftime("%Y-%m-%d %H:%M:%S"),
+                }
+        return jsonify(get_job_response(data, coderr=1, deserr=repr(job.error)))
+    return jsonify(job.result)
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    "queue a monitoring request (same JSON as /monitor): returns the job id"
+    content = request.json
+    if not content:
+        raise Exception("No JSON content received")
+    job_id = job_queue.submit(dict(content))
+    return jsonify(get_job_response(job_queue.status(job_id))), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    "status of a job: queued, running, done or failed"
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify(get_job_response(coderr=1, deserr=f"job {job_id} not found")), 404
+    return jsonify(get_job_response(status))
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    "result of a finished job (the response of /monitor)"
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify(get_job_response(coderr=1, deserr=f"job {job_id} not found")), 404
+    if job.status == jobs.JOB_FAILED:
+        return jsonify(get_job_response(job_queue.status(job_id), coderr=1, deserr=repr(job.error))), 500
+    if job.status != jobs.JOB_DONE:
+        return jsonify(get_job_response(job_queue.status(job_id), coderr=1, deserr=f"job {job_id} is {job.status}")), 409
+    return jsonify(job.result)
 
 
 if __name__ == '__main__':
+    # job processes, each one with its Rao's Q workers and the cached forest masks and
+    # N2000 layers kept warm across requests
+    job_queue.start()
     serve(app, host="0.0.0.0", port=8000)
 
 
@@ -0,0 +1,58 @@
+# MICRO-BENCHMARK: 3I3D reference implementation (f_3i3d) vs fused kernel (f_3i3d_fused)
+# usage: python bench_3i3d.py [rows] [cols] [repeat]
+import sys
+import time
+import warnings
+
+import numpy as np
+
+import mon
+
+
+def f_get_random_dataset(rows, cols, seed=0):
+    "random reflectances (with zeros and nodata) for the pre, now, post images"
+    rng = np.random.default_rng(seed)
+    ds = mon.DD()
+    for image in ('pre', 'now', 'post'):
+        ds[image] = mon.DD()
+        for band in ('nir', 'swir1', 'swir2'):
+            data = rng.uniform(0, 0.6, (rows, cols)).astype(np.float32)
+            data[rng.random((rows, cols)) < 0.01] = 0
+            data[rng.random((rows, cols)) < 0.001] = np.nan
+            ds[image][band] = data
+    return ds
+
+
+def f_copy_dataset(ds):
+    "f_3i3d modifies the dataset"
+    ds_copy = mon.DD()
+    for image in ds:
+        ds_copy[image] = mon.DD(ds[image])
+    return ds_copy
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else 4000
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    th = 224
+    mon.logger = mon.fake_logger()
+    warnings.filterwarnings('ignore', category=RuntimeWarning)  # nodata and zeros in the random bands
+    ds = f_get_random_dataset(rows, cols)
+
+    time2 = {'f_3i3d': [], 'f_3i3d_fused': []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        magnitude, change_map = mon.f_3i3d(f_copy_dataset(ds), th, debug=False)
+        time2['f_3i3d'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        magnitude_fused, change_map_fused = mon.f_3i3d_fused(ds, th)
+        time2['f_3i3d_fused'].append(time.perf_counter() - start)
+
+    if not (np.array_equal(magnitude, magnitude_fused) and np.array_equal(change_map, change_map_fused)):
+        raise Exception('f_3i3d_fused differs from f_3i3d')
+    print(f'raster {rows} x {cols}, best of {repeat}: results are identical')
+    for name in time2:
+        print(f'{name:>14}: {min(time2[name]):.3f} s')
+    print(f'{"speedup":>14}: {min(time2["f_3i3d"]) / min(time2["f_3i3d_fused"]):.1f}x')
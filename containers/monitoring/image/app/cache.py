@@ -0,0 +1,264 @@
+# cache of the static layers of a region: forest mask, N2000 sites and their
+# rasterization on the EPSG:3035 grid. These inputs never change between requests:
+# the layers are built once (e.g. at container start), saved as .npy files keyed by
+# region and source file hash, and memory-mapped by the later requests.
+# cache of the monitoring results (content-addressed): the products depending only on
+# the satellite and static inputs are reused by the requests with the same inputs
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.windows
+from rasterio.windows import Window
+from rasterio.features import geometry_mask
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.transform import Affine
+from rasterio.crs import CRS
+import geopandas as gpd
+import shapely
+
+import zonal
+
+
+CACHE_DIR = '../data/cache/'
+CACHE_VERSION = 1  # increase when the cached layers change
+RESULT_CACHE_DIR = os.path.join(CACHE_DIR, 'results')
+RESULT_CACHE_SIZE = int(os.environ.get('MON_RESULT_CACHE_SIZE', 4))  # results kept. 0: no result cache
+RESULT_CACHE_LOCK = 'lock'  # lock file of the result cache directory
+N2000_BBOX_BUFFER = 20  # meters added to the N2000 bounding boxes (10 m for each side)
+STATIC_CRS = 'EPSG:3035'
+
+# static layers of a region
+# fmask: forest mask on its own grid (crs, transform)
+# fmask_sites, footprint, zones: forest mask, union of the N2000 bounding boxes and
+#   N2000 sites rasterized on the EPSG:3035 grid window covering the sites
+#   (transform_sites). The EPSG:3035 grid is the default one of the forest mask
+# sites, bbox: N2000 sites and their bounding boxes (buffered)
+StaticLayers = namedtuple('StaticLayers', [
+    'fmask', 'crs', 'transform',
+    'fmask_sites', 'footprint', 'zones', 'transform_sites',
+    'sites', 'bbox',
+])
+
+# layers already loaded by this process
+_static_layers = dict()
+_file_hashes = dict()
+
+
+# Hash of the content of a file (and of its sidecar files, e.g. .dbf of a .shp).
+# The hash of a file not modified since the last call is not computed again
+def file_hash(path):
+    root, ext = os.path.splitext(path)
+    paths = [path]
+    if ext == '.shp':
+        paths += [root + x for x in ('.shx', '.dbf', '.prj', '.cpg') if os.path.exists(root + x)]
+    hash2 = []
+    for p in paths:
+        stat = os.stat(p)
+        key = (os.path.abspath(p), stat.st_size, stat.st_mtime_ns)
+        if key not in _file_hashes:
+            h = hashlib.sha1()
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    h.update(chunk)
+            _file_hashes[key] = h.hexdigest()
+        hash2.append(_file_hashes[key])
+    return hashlib.sha1(''.join(hash2).encode()).hexdigest()
+
+
+# Build the static layers and save them in dir_layers
+def build_static_layers(path_forest_mask, path_n2000_sites, dir_layers):
+    with rasterio.open(path_forest_mask) as src:
+        fmask = np.squeeze(src.read()).astype(np.uint8)
+        crs = src.crs
+        transform = src.transform
+        # default EPSG:3035 grid of the forest mask
+        transform_3035, width_3035, height_3035 = calculate_default_transform(
+            src.crs, STATIC_CRS, src.width, src.height, *src.bounds)
+
+    # N2000 bounding boxes and the grid window covering them
+    sites = gpd.read_file(path_n2000_sites)
+    bbox = sites.buffer(N2000_BBOX_BUFFER, cap_style='square').envelope
+    # (the boxes are rasterized only on their total bounds)
+    bounds = rasterio.windows.from_bounds(*bbox.total_bounds, transform=transform_3035)
+    row_start = max(int(np.floor(bounds.row_off)), 0)
+    col_start = max(int(np.floor(bounds.col_off)), 0)
+    row_end = min(int(np.ceil(bounds.row_off + bounds.height)), height_3035)
+    col_end = min(int(np.ceil(bounds.col_off + bounds.width)), width_3035)
+    if row_start >= row_end or col_start >= col_end:
+        raise Exception(f'{path_n2000_sites}: no N2000 site in the forest mask extent')
+    window_bounds = Window.from_slices((row_start, row_end), (col_start, col_end))
+    footprint = geometry_mask(
+        bbox,
+        out_shape=(row_end - row_start, col_end - col_start),
+        transform=rasterio.windows.transform(window_bounds, transform_3035),
+        invert=True,
+    )
+    rows = np.flatnonzero(footprint.any(axis=1))
+    cols = np.flatnonzero(footprint.any(axis=0))
+    footprint = footprint[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    window_sites = Window.from_slices(
+        (row_start + rows[0], row_start + rows[-1] + 1),
+        (col_start + cols[0], col_start + cols[-1] + 1),
+    )
+    transform_sites = rasterio.windows.transform(window_sites, transform_3035)
+
+    # forest mask and N2000 sites on the window
+    fmask_sites = np.zeros(footprint.shape, dtype=np.uint8)
+    reproject(
+        source=fmask,
+        destination=fmask_sites,
+        src_transform=transform,
+        src_crs=crs,
+        dst_transform=transform_sites,
+        dst_crs=STATIC_CRS,
+        resampling=Resampling.nearest)
+    zones = zonal.rasterize_zones(sites.geometry, footprint.shape, transform_sites)
+
+    np.save(os.path.join(dir_layers, 'fmask.npy'), fmask)
+    np.save(os.path.join(dir_layers, 'fmask_sites.npy'), fmask_sites)
+    np.save(os.path.join(dir_layers, 'footprint.npy'), footprint)
+    np.save(os.path.join(dir_layers, 'zone_ix.npy'), zones.zone_ix)
+    np.save(os.path.join(dir_layers, 'pixel_ix.npy'), zones.pixel_ix)
+    np.save(os.path.join(dir_layers, 'bbox.npy'), bbox.bounds.to_numpy())
+    meta = {
+        'path_forest_mask': path_forest_mask,
+        'path_n2000_sites': path_n2000_sites,
+        'crs': crs.to_wkt(),
+        'transform': list(transform)[:6],
+        'transform_sites': list(transform_sites)[:6],
+        'n_zones': zones.n_zones,
+    }
+    with open(os.path.join(dir_layers, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+# Load the static layers saved in dir_layers (arrays are memory-mapped, read-only)
+def load_static_layers(path_n2000_sites, dir_layers):
+    with open(os.path.join(dir_layers, 'meta.json')) as f:
+        meta = json.load(f)
+    npy2 = dict()
+    for name in ('fmask', 'fmask_sites', 'footprint', 'zone_ix', 'pixel_ix', 'bbox'):
+        npy2[name] = np.load(os.path.join(dir_layers, f'{name}.npy'), mmap_mode='r')
+    sites = gpd.read_file(path_n2000_sites)
+    bbox = gpd.GeoSeries(shapely.box(*npy2['bbox'].T), index=sites.index, crs=sites.crs)
+    zones = zonal.Zones(npy2['zone_ix'], npy2['pixel_ix'], meta['n_zones'], npy2['footprint'].shape)
+    return StaticLayers(
+        fmask=npy2['fmask'],
+        crs=CRS.from_wkt(meta['crs']),
+        transform=Affine(*meta['transform']),
+        fmask_sites=npy2['fmask_sites'],
+        footprint=npy2['footprint'],
+        zones=zones,
+        transform_sites=Affine(*meta['transform_sites']),
+        sites=sites,
+        bbox=bbox,
+    )
+
+
+# Get the static layers of a region: loaded from memory, from the cache directory
+# or built (and saved) if the source files are new or changed
+def get_static_layers(path_forest_mask, path_n2000_sites, region=None, dir_cache=CACHE_DIR):
+    source_hash = hashlib.sha1(
+        (file_hash(path_forest_mask) + file_hash(path_n2000_sites)).encode()
+    ).hexdigest()
+    key = f'{region}_{CACHE_VERSION}_{source_hash[:16]}'
+    if key in _static_layers:
+        return _static_layers[key]
+
+    dir_layers = os.path.join(dir_cache, key)
+    if not os.path.exists(os.path.join(dir_layers, 'meta.json')):
+        # build in a temporary directory, then move it: concurrent requests never
+        # see partial layers
+        os.makedirs(dir_cache, exist_ok=True)
+        dir_build = tempfile.mkdtemp(prefix=f'tmp_{key}_', dir=dir_cache)
+        try:
+            build_static_layers(path_forest_mask, path_n2000_sites, dir_build)
+            os.rename(dir_build, dir_layers)
+        except OSError:
+            if not os.path.exists(os.path.join(dir_layers, 'meta.json')):
+                raise
+        finally:
+            shutil.rmtree(dir_build, ignore_errors=True)
+
+    _static_layers[key] = load_static_layers(path_n2000_sites, dir_layers)
+    return _static_layers[key]
+
+
+# Key of the results computed from the input files and the parameters (e.g. region,
+# algorithm version)
+def get_result_key(paths, **params):
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(file_hash(path).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+# Lock of the result cache, shared by the job processes: readers copy the cached
+# results under a shared lock, the least recently used results are removed under an
+# exclusive lock (never while a request is copying them)
+@contextlib.contextmanager
+def lock_results(dir_cache=RESULT_CACHE_DIR, exclusive=False):
+    os.makedirs(dir_cache, exist_ok=True)
+    with open(os.path.join(dir_cache, RESULT_CACHE_LOCK), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Load the cached results of key: files {name: path} are copied to their paths and
+# the tables (list of names) are read. Returns the tables {name: DataFrame}, None if
+# the results are not cached
+def load_results(key, files, tables, dir_cache=RESULT_CACHE_DIR):
+    if RESULT_CACHE_SIZE <= 0:
+        return None
+    dir_results = os.path.join(dir_cache, key)
+    with lock_results(dir_cache):
+        if not os.path.exists(os.path.join(dir_results, 'meta.json')):
+            return None
+        os.utime(dir_results)  # most recently used
+        for name, path in files.items():
+            shutil.copyfile(os.path.join(dir_results, name), path)
+        return {name: pd.read_pickle(os.path.join(dir_results, f'{name}.pkl')) for name in tables}
+
+
+# Save the results of key: files {name: path} are copied and tables {name: DataFrame}
+# pickled in the cache directory. The least recently used results are removed
+# (see lock_results)
+def save_results(key, files, tables, dir_cache=RESULT_CACHE_DIR):
+    if RESULT_CACHE_SIZE <= 0:
+        return
+    dir_results = os.path.join(dir_cache, key)
+    os.makedirs(dir_cache, exist_ok=True)
+    dir_build = tempfile.mkdtemp(prefix=f'tmp_{key}_', dir=dir_cache)
+    try:
+        for name, path in files.items():
+            shutil.copyfile(path, os.path.join(dir_build, name))
+        for name, df in tables.items():
+            df.to_pickle(os.path.join(dir_build, f'{name}.pkl'))
+        with open(os.path.join(dir_build, 'meta.json'), 'w') as f:
+            json.dump({'files': list(files), 'tables': list(tables)}, f)
+        os.rename(dir_build, dir_results)
+    except OSError:
+        if not os.path.exists(os.path.join(dir_results, 'meta.json')):
+            raise
+    finally:
+        shutil.rmtree(dir_build, ignore_errors=True)
+
+    with lock_results(dir_cache, exclusive=True):
+        dir2 = [os.path.join(dir_cache, x) for x in os.listdir(dir_cache)
+                if not (x.startswith('tmp_') or x == RESULT_CACHE_LOCK)]
+        dir2 = sorted(dir2, key=os.path.getmtime, reverse=True)
+        for dir_old in dir2[RESULT_CACHE_SIZE:]:
+            shutil.rmtree(dir_old, ignore_errors=True)
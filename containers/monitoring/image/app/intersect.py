@@ -0,0 +1,46 @@
+# intersections of two layers (e.g. FMP polygons and EOP disturbances): the candidate
+# pairs are found with an STRtree query, then only the intersections of those pairs
+# are computed (by chunks in a pool). Same pairs and order as gpd.sjoin / gpd.overlay
+import numpy as np
+import pandas as pd
+import shapely
+
+
+INTERSECT_CHUNK_PAIRS = 5000  # pairs intersected by a task
+
+
+# Pairs (ix_left, ix_right) of positional indices of the geometries of left and right
+# satisfying predicate, sorted by left then right (as gpd.overlay)
+def query_pairs(left, right, predicate='intersects'):
+    tree = shapely.STRtree(np.asarray(right.geometry.values))
+    ix_left, ix_right = tree.query(np.asarray(left.geometry.values), predicate=predicate)
+    order = np.lexsort((ix_right, ix_left))
+    return ix_left[order], ix_right[order]
+
+
+# Area of the intersection of every pair of geometries
+def intersection_area(geoms_left, geoms_right):
+    return shapely.area(shapely.intersection(geoms_left, geoms_right))
+
+
+# Intersection area of the pairs of geometries of left and right with a polygonal
+# intersection (as gpd.overlay, how='intersection'). Returns a DataFrame with the
+# positional indices (ix_left, ix_right) and the area of each pair. Chunks of pairs
+# are processed by pool (a concurrent.futures executor) if given
+def intersection_pairs(left, right, pool=None, chunk_pairs=None):
+    chunk_pairs = chunk_pairs or INTERSECT_CHUNK_PAIRS
+    ix_left, ix_right = query_pairs(left, right)
+    geoms_left = np.asarray(left.geometry.values)[ix_left]
+    geoms_right = np.asarray(right.geometry.values)[ix_right]
+    if pool is not None and ix_left.size > chunk_pairs:
+        chunks = [slice(start, start + chunk_pairs) for start in range(0, ix_left.size, chunk_pairs)]
+        area = np.concatenate(list(pool.map(
+            intersection_area,
+            [geoms_left[chunk] for chunk in chunks],
+            [geoms_right[chunk] for chunk in chunks],
+        )))
+    else:
+        area = intersection_area(geoms_left, geoms_right)
+    # pairs touching only on the boundary (no polygonal intersection) are dropped
+    keep = area > 0
+    return pd.DataFrame({'ix_left': ix_left[keep], 'ix_right': ix_right[keep], 'area': area[keep]})
@@ -0,0 +1,204 @@
+# queue of the monitoring jobs: a request is submitted and gets a job id, a bounded
+# pool of job processes runs the jobs (each one in its own temporary directory) and
+# the clients poll the job status and result. A job starts only when the memory it
+# needs (estimated from the size of its input rasters) is available, so several
+# regions can be monitored at the same time on one host.
+# Jobs run in processes, not threads: the netcdf/hdf5 libraries are not thread-safe
+# and mon keeps the state of the request in module globals
+import os
+import uuid
+import shutil
+import threading
+import multiprocessing
+import multiprocessing.util
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import netCDF4
+import psutil
+
+import mon
+import rao_q_lin
+
+
+JOB_DIR = '../data/jobs/'
+# job processes: jobs running at the same time
+MON_MAX_JOBS = int(os.environ.get('MON_MAX_JOBS', 2))
+# memory (bytes) that the running jobs can use. 0: 75% of the host memory
+MON_JOBS_MEMORY = int(os.environ.get('MON_JOBS_MEMORY', 0))
+# estimated peak memory (bytes) of a job for each pixel of the input rasters
+# (3i3d blocks, change maps, component labels, reprojected rasters)
+JOB_MEMORY_PER_PIXEL = 48
+JOB_MEMORY_MIN = 2**30
+# finished jobs kept (status and result)
+JOB_HISTORY_SIZE = 100
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+# Estimated peak memory (bytes) of a monitoring job: pixels of its Sentinel-2 composites.
+# Invalid inputs are reported by the job (mon.f_get_parameters): JOB_MEMORY_MIN
+def estimate_job_memory(mon_input, dir_data='../data/'):
+    pixels = 0
+    try:
+        for name in mon_input.get('path_file_preprocessing', []):
+            path = os.path.join(dir_data, name)
+            if not (name.endswith('.nc') and os.path.exists(path)):
+                continue
+            with netCDF4.Dataset(path) as nc:
+                pixels = max(pixels, len(nc.dimensions['x']) * len(nc.dimensions['y']))
+    except Exception:
+        return JOB_MEMORY_MIN
+    return max(pixels * JOB_MEMORY_PER_PIXEL, JOB_MEMORY_MIN)
+
+
+# Initialize a job process: the CPUs are shared by the Rao's Q pools of the job
+# processes, which are started (with the static layers) before the first job
+def init_job_process(max_jobs):
+    rao_q_lin.RAOQ_MAX_WORKERS = max((multiprocessing.cpu_count() - rao_q_lin.RAOQ_RESERVED_CPUS) // max_jobs, 1)
+    rao_q_lin.start_backend()
+    # the Rao's Q workers are stopped when the job process exits, before its queues
+    # are closed (finalizers with exitpriority 10) and its children joined
+    multiprocessing.util.Finalize(None, rao_q_lin.stop_backend, exitpriority=100)
+    mon.warm_static_layers()
+
+
+# FIFO queue of jobs run by max_jobs job processes. run(job) computes the result of a
+# job (mon.DD with id, input, dir and the submit options) in a job process: run must
+# be a module-level function. An exception marks the job as failed
+class JobQueue():
+    def __init__(self, run, max_jobs=None, memory=None, dir_jobs=JOB_DIR):
+        self.run = run
+        self.max_jobs = max_jobs or MON_MAX_JOBS
+        self.memory = memory or MON_JOBS_MEMORY or int(psutil.virtual_memory().total * 0.75)
+        self.dir_jobs = dir_jobs
+        self.jobs = dict()
+        self.queue = deque()
+        self.history = deque()
+        self.memory_used = 0
+        self.n_running = 0
+        self.lock = threading.Condition()
+        self.executor = None
+        self.workers = []
+
+    def start(self):
+        "start the job processes and the threads dispatching the jobs (no-op if running)"
+        with self.lock:
+            if self.workers:
+                return
+            self._start_executor()
+            for _ in range(self.max_jobs):
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, mon_input, **options):
+        "queue a job (options: attributes of the job read by run). Returns its id"
+        self.start()
+        job = mon.DD()
+        job.id = uuid.uuid4().hex
+        job.input = mon_input
+        job.options = options
+        job.status = JOB_QUEUED
+        job.memory = estimate_job_memory(mon_input)
+        job.dir = os.path.join(self.dir_jobs, job.id) + '/'
+        job.submitted = datetime.now()
+        job.started = None
+        job.ended = None
+        job.result = None
+        job.error = None
+        job.done = threading.Event()
+        with self.lock:
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.lock.notify_all()
+        return job.id
+
+    def get(self, job_id):
+        "job of job_id (None if unknown)"
+        return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        "status of a job as a dict (None if unknown)"
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            position = next((ix for ix, x in enumerate(self.queue) if x is job), None)
+        status = {
+            'job_id': job.id,
+            'status': job.status,
+            'submitted': job.submitted.strftime("%Y-%m-%d %H:%M:%S"),
+            'started': job.started.strftime("%Y-%m-%d %H:%M:%S") if job.started else None,
+            'ended': job.ended.strftime("%Y-%m-%d %H:%M:%S") if job.ended else None,
+        }
+        if position is not None:
+            status['queue_position'] = position
+        return status
+
+    def wait(self, job_id, timeout=None):
+        "wait for the end of a job. Returns the job"
+        job = self.jobs[job_id]
+        job.done.wait(timeout)
+        return job
+
+    def _start_executor(self):
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_job_process,
+            initargs=(self.max_jobs,),
+        )
+
+    def _can_start(self, job):
+        # the first job always starts: a job larger than the memory runs alone
+        return self.n_running == 0 or self.memory_used + job.memory <= self.memory
+
+    def _work(self):
+        while True:
+            with self.lock:
+                # jobs start in submission order
+                while not (self.queue and self._can_start(self.queue[0])):
+                    self.lock.wait()
+                job = self.queue.popleft()
+                self.memory_used += job.memory
+                self.n_running += 1
+                job.status = JOB_RUNNING
+                job.started = datetime.now()
+                executor = self.executor
+            try:
+                os.makedirs(job.dir, exist_ok=True)
+                job_run = mon.DD(job.options, id=job.id, input=job.input, dir=job.dir)
+                job.result = executor.submit(self.run, job_run).result()
+                job.status = JOB_DONE
+            except BrokenProcessPool as e:
+                # a job process died (e.g. out of memory): new processes for the next jobs
+                job.error = e
+                job.status = JOB_FAILED
+                with self.lock:
+                    if self.executor is executor:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        self._start_executor()
+            except Exception as e:
+                job.error = e
+                job.status = JOB_FAILED
+            finally:
+                shutil.rmtree(job.dir, ignore_errors=True)
+                job.ended = datetime.now()
+                with self.lock:
+                    self.memory_used -= job.memory
+                    self.n_running -= 1
+                    self._forget(job)
+                    self.lock.notify_all()
+                job.done.set()
+
+    def _forget(self, job):
+        # keep the last JOB_HISTORY_SIZE finished jobs
+        self.history.append(job.id)
+        while len(self.history) > JOB_HISTORY_SIZE:
+            self.jobs.pop(self.history.popleft(), None)
@@ -8,7 +8,6 @@ import numpy as np
 import rasterio as rio
 import xarray as xr
 import rioxarray
-import geopandas as gpd
 
 #import h5py
 import netCDF4
@@ -17,20 +16,29 @@ import h5netcdf
 # import string
 from datetime import datetime
 import rao_q_lin
+import cache
+import vectorize
 import alert
 
-
-# polygonize
-import fiona
-import rasterio.features
-from shapely.geometry import shape, mapping
-from shapely.geometry.polygon import Polygon
 import pickle
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 # connected pixel filtering
 import cv2
 
 TESTING = 1
+# rows of the 3i3d blocks (peak memory of the 3i3d step). 0: whole raster at once
+MON_BLOCK_ROWS = int(os.environ.get('MON_BLOCK_ROWS', 1024))
+# pixels of the 3i3d tiles computed by each thread (temporaries kept in the CPU cache)
+MON_TILE_PIXELS = 2**16
+# version of the monitoring algorithms: increase when the results change (cached results)
+MON_VERSION = 1
+REGIONS = { # managed regions (ISTAT code)
+        10: 'Umbria',
+        12: 'Lazio'
+        }
 
 # web
 
@@ -60,9 +68,11 @@ def f_get_mask(path):
         return np.squeeze(f.read()).astype(np.uint8)
 
 
-def f_get_dataset_nc_xarray(path3, mask=0):
+def f_get_dataset_nc_xarray(path3, mask=0, rows=slice(None)):
     '''
     requires files named pre.nc, now.nc, post.nc in folder
+    path3 values: paths or datasets already opened with rioxarray
+    rows: <slice> rows to read (default: all the raster)
     '''
     # rename bands
     #bandnames = ['B2'   , 'B3'    , 'B4'  , 'B8'  , 'B9', 'B8A'   , 'B11'   , 'B12']
@@ -78,15 +88,15 @@ def f_get_dataset_nc_xarray(path3, mask=0):
     for ix in p3:
         d3[ix] = DD()
         path = p3[ix]
-        with rioxarray.open_rasterio(path) as f:
+        with (rioxarray.open_rasterio(path) if isinstance(path, str) else contextlib.nullcontext(path)) as f:
             for band in band_dict.keys():
-                data = f[band].data.astype(np.float32)
+                data = f[band][:, rows].data.astype(np.float32)
                 #data[data==9.969209968386869e+36] = np.nan #TODO: risolvere con Almaviva
                 band_new = band_dict[band]
                 if type(mask) == int:
                     d3[ix][band_new] = data[0][:][:]
                 else:
-                    d3[ix][band_new] = data[0][:][:] * np.squeeze(mask)
+                    d3[ix][band_new] = data[0][:][:] * np.squeeze(mask)[rows]
     return d3, path3['pre']
 
 
@@ -131,6 +141,42 @@ def f_write_nc(reference, out_path, group, data_dict, crs=4326, metadata_dict=No
     xd.close()
 
 
+def f_create_nc(reference, out_path, var_dtype, crs=4326, metadata_dict=None, chunk_rows=None):
+    '''create the netcdf variables (same layout of f_write_nc), to be written by blocks
+    ref: <str> path to netcdf data used as reference
+    out_path: <str> output path for writing netcdf (overwritten if it exists)
+    var_dtype: <dict> dtype of each variable
+    crs: <int> crs epsg code
+    metadata_dict: dictionary containing metadata. The dict is nested using var_name
+    chunk_rows: <int> rows of each netcdf chunk (default: all the rows)
+    '''
+    with rioxarray.open_rasterio(reference) as ref:
+        arr_x = xr.DataArray(ref.x.data, dims=['longitude'])
+        arr_y = xr.DataArray(ref.y.data, dims=['latitude'])
+    if metadata_dict:
+        arr_x = f_set_attrs(arr_x, 'x', metadata_dict)
+        arr_y = f_set_attrs(arr_y, 'y', metadata_dict)
+
+    # dimensions, coordinates and crs (written by xarray)
+    xd = xr.Dataset(coords={'latitude': arr_y, 'longitude': arr_x})
+    xd = xd.rio.write_crs(rio.crs.CRS.from_user_input(crs))
+    xd.to_netcdf(out_path, format='NETCDF4', engine='netcdf4', mode='w')
+    xd.close()
+
+    # empty variables
+    chunksizes = (min(chunk_rows or arr_y.size, arr_y.size), arr_x.size)
+    with netCDF4.Dataset(out_path, 'a') as nc:
+        for key in var_dtype:
+            dtype = np.dtype(var_dtype[key])
+            fill_value = np.nan if dtype.kind == 'f' else None
+            var = nc.createVariable(
+                    key, dtype, ('latitude', 'longitude'),
+                    zlib=True, complevel=5, chunksizes=chunksizes, fill_value=fill_value,
+                    )
+            if metadata_dict and key in metadata_dict:
+                var.setncatts(metadata_dict[key])
+
+
 def f_set_attrs(var, var_name, metadata_dict):
     '''set attributes of netcdf data
     xa: <xarray dataset>
@@ -164,18 +210,8 @@ def f_con(x, v1, v2):
     return np.abs((v2 - np.abs(x - v1))/v2)
 
 
-def f_3i3d(
-        ds: DD,
-        th: int,             # threshold
-        debug: bool = True
-         ) -> (np.array, np.array):
-    '''
-    dataset: image dataset<DD>
-    image names = 'pre', 'now', 'post'
-    returns (magnitude, change_map)
-        magnitude: 8 bit image (probability of forest anomaly)
-        change_map: 1 bit image (forest anomaly mask)
-    '''
+def f_check_dataset(ds: DD):
+    "check that the pre, now, post images and their bands are in the dataset"
     req2 = ['pre', 'now', 'post']
     band2 = ['swir1', 'swir2', 'nir']
     for req1 in req2:
@@ -189,6 +225,20 @@ def f_3i3d(
                 raise LookupError('band {a} not found in {b} image'.format(a=band1, b=req1))
 
 
+def f_3i3d(
+        ds: DD,
+        th: int,             # threshold
+        debug: bool = True
+         ) -> (np.array, np.array):
+    '''
+    dataset: image dataset<DD>
+    image names = 'pre', 'now', 'post'
+    returns (magnitude, change_map)
+        magnitude: 8 bit image (probability of forest anomaly)
+        change_map: 1 bit image (forest anomaly mask)
+    '''
+    f_check_dataset(ds)
+
     # logger.info("step 1 ok")
     c_todegree = 180 / np.pi
     #c_todegree = 180 / 3.1416
@@ -259,9 +309,144 @@ def f_3i3d(
     #    print('debug: modulo_a')
     #    return(modulo_a, modulo_b, theta_a, theta_b, dE, p_theta_a, magnitude, change_map)
     #else:
-    logger.info("3i3d mapping complete")
+    if debug:
+        logger.info("3i3d mapping complete")
     return(magnitude_8bit, change_map)
 
+
+def f_3i3d_tile(ds, rows, th, magnitude_8bit, change_map):
+    '''
+    3i3d of the rows of the dataset, written in magnitude_8bit and change_map.
+    Same float32 operations of f_3i3d (same result, bit for bit), computed in place
+    on a tile small enough to keep the temporaries in the CPU cache
+    '''
+    c_todegree = 180 / np.pi
+    d3 = []
+    for image in ('pre', 'now', 'post'):
+        nir = ds[image].nir[rows]
+        msi = ds[image].swir1[rows] / nir
+        nir = np.where(nir == 0, 0.0001, nir)
+        ndi2 = []
+        for swir in (ds[image].swir1[rows], ds[image].swir2[rows]):
+            # normalized difference (f_ndif)
+            swir = np.where(swir == 0, 0.0001, swir)
+            ndi = nir - swir
+            swir += nir
+            ndi /= swir
+            ndi2.append(ndi)
+        d3.append((ndi2[0], ndi2[1], msi))
+    (ndmi_pre, nbr_pre, msi_pre), (ndmi_now, nbr_now, msi_now), (ndmi_post, nbr_post, msi_post) = d3
+
+    # difference vectors
+    x_a = ndmi_now - ndmi_pre
+    y_a = nbr_now - nbr_pre
+    z_a = msi_now - msi_pre
+    ndmi_post -= ndmi_now
+    nbr_post -= nbr_now
+    msi_post -= msi_now
+    x_b, y_b, z_b = ndmi_post, nbr_post, msi_post
+    del d3, ndmi_pre, nbr_pre, msi_pre, ndmi_now, nbr_now, msi_now
+
+    # p_theta (f_con of theta): the magnitude of each vector is used only here
+    p_theta2 = []
+    for x, y, z, v1 in ((x_a, y_a, z_a, 45), (x_b, y_b, z_b, 135)):
+        modulo = f_magnitude(x, y, z)
+        np.divide(z, modulo, out=modulo)
+        np.arccos(modulo, out=modulo)
+        modulo *= c_todegree
+        p_theta2.append(f_con(modulo, v1, 135))
+    magnitude = p_theta2[0]
+    magnitude += p_theta2[1]
+
+    # p_phi (f_con of phi)
+    np.copyto(x_a, 0.0001, where=x_a == 0)
+    np.copyto(x_b, 0.0001, where=x_b == 0)
+    for x, y, v1, v2 in ((x_a, y_a, 225, 315), (x_b, y_b, 45, 225)):
+        phi = np.divide(y, x)
+        np.arctan(phi, out=phi)
+        phi *= c_todegree
+        np.add(phi, 180, out=phi, where=x < 0)
+        magnitude += f_con(phi, v1, v2)
+
+    # dE
+    x_a -= x_b
+    y_a -= y_b
+    z_a -= z_b
+    magnitude += x_a**2 + y_a**2 + z_a**2
+
+    magnitude *= 255
+    magnitude /= 5
+    magnitude_8bit[rows] = np.where(magnitude > 255, 255, magnitude)
+    np.greater(magnitude_8bit[rows], th, out=change_map[rows])
+
+
+def f_3i3d_fused(
+        ds: DD,
+        th: int,             # threshold
+        tile_pixels: int = None,
+        n_threads: int = None,
+         ) -> (np.array, np.array):
+    '''
+    same result of f_3i3d (bit for bit), computed by tiles of rows (f_3i3d_tile)
+    on n_threads threads, without full-size temporaries. The dataset is not modified
+    tile_pixels: pixels of each tile (default: MON_TILE_PIXELS)
+    '''
+    f_check_dataset(ds)
+    tile_pixels = tile_pixels or MON_TILE_PIXELS
+    n_threads = n_threads or os.cpu_count()
+    shape = ds.pre.nir.shape
+    tile_rows = max(tile_pixels // max(shape[1], 1), 1)
+    magnitude_8bit = np.empty(shape, dtype=np.uint8)
+    change_map = np.empty(shape, dtype=bool)
+    tiles = [slice(row, row + tile_rows) for row in range(0, shape[0], tile_rows)]
+    with ThreadPoolExecutor(n_threads) as pool:
+        for _ in pool.map(lambda rows: f_3i3d_tile(ds, rows, th, magnitude_8bit, change_map), tiles):
+            pass
+    return magnitude_8bit, change_map
+
+
+def f_3i3d_streaming(path3, mask, th, out_path, metadata_dict, block_rows=None):
+    '''
+    3i3d computed by blocks of rows: each block is read from the pre, now, post
+    images and its magnitude and change map are written to the output netcdf.
+    Peak memory depends on block_rows, the result is the same of f_3i3d
+    path3: <dict> image paths ('pre', 'now', 'post')
+    th: <int> threshold
+    out_path: <str> output netcdf
+    block_rows: <int> rows of each block (default: MON_BLOCK_ROWS)
+    returns the change map (uint8), kept in memory for the post-processing
+    '''
+    block_rows = block_rows or MON_BLOCK_ROWS
+    reference = path3['pre']
+    with rioxarray.open_rasterio(reference) as ref:
+        height = ref.y.size
+        width = ref.x.size
+    change_map_all = np.empty((height, width), dtype=np.uint8)
+
+    var_dtype = {'magnitude': np.float32, 'change_map': np.uint8}
+    # written to a temporary file moved to out_path when complete: a previous
+    # (or partial) output is replaced and never left half written
+    fd, tmp_path = tempfile.mkstemp(suffix='.nc', dir=os.path.dirname(os.path.abspath(out_path)))
+    os.close(fd)
+    try:
+        f_create_nc(reference, tmp_path, var_dtype, metadata_dict=metadata_dict, chunk_rows=block_rows)
+        with contextlib.ExitStack() as stack, netCDF4.Dataset(tmp_path, 'a') as nc:
+            # input images opened once for all the blocks
+            files3 = {ix: stack.enter_context(rioxarray.open_rasterio(path3[ix])) for ix in path3}
+            for row in range(0, height, block_rows):
+                rows = slice(row, min(row + block_rows, height))
+                data3, _ = f_get_dataset_nc_xarray(files3, mask, rows)
+                magnitude, change_map = f_3i3d_fused(data3, th)
+                nc['magnitude'][rows] = magnitude.astype(np.float32)
+                change_map_all[rows] = change_map
+                nc['change_map'][rows] = change_map_all[rows]
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info("3i3d mapping complete")
+    return change_map_all
+
 # -- POSTPROCESSING ----------------------------------------------------------
 def f_get_mask_pixel_filtering(raster_bool, band_name, par3):
     if type(raster_bool) == str:
@@ -274,33 +459,38 @@ def f_get_mask_pixel_filtering(raster_bool, band_name, par3):
     else:
         raise NotImplementedError
 
+    start = datetime.now()
     output = cv2.connectedComponentsWithStats(
         data)
     (numLabels, labels, stats, centroids) = output
-    mask = np.zeros(data.shape, dtype="uint8") # empty mask
-
-    counter = 0
-    # label zero is the background
-    for i in range(1, numLabels):
-        counter += 1
-        area = stats[i, cv2.CC_STAT_AREA]   #
-        keepArea = area > par3['area_min_th'] and area < par3['area_max_th']
-        if keepArea:
-            mask[labels == i] = 1
-        print("progress: {} / 100%".format(int((counter/numLabels) * 100), 2), end=" \r")
+    labels_end = datetime.now()
+
+    # lookup table of the labels to keep (by area), applied in a single pass
+    area = stats[:, cv2.CC_STAT_AREA]
+    keep = (area > par3['area_min_th']) & (area < par3['area_max_th'])
+    keep[0] = False  # label zero is the background
+    mask = keep.astype(np.uint8)[labels]
+
+    end = datetime.now()
+    logger.info(
+        f"pixel filtering: {numLabels - 1} components, {np.count_nonzero(keep)} kept. "
+        f"labels: {(labels_end - start).total_seconds()} s, "
+        f"filter: {(end - labels_end).total_seconds()} s"
+    )
     return mask
 
 
-def f_apply_raster_filter(par, region):
-    path3 = par.path_data[region].sentinel2
-    meta3 = par.n2000[region].meta3
-
+def f_filter_change_map(change_map):
+    '''
+    remove forest anomalies and their holes by area
+    change_map: <str> path of the 3i3d netcdf or <np.array> change map
+    '''
     print("filtering forest anomalies")
     par3 = {
             'area_min_th': 10,   # pixel. Area: 100 (pixel) * 100 (m2 pixel) = 10000 (1 ha)
             'area_max_th': 5000,  # pixel. Area: 5000 (pixel) * 100 (m2 pixel) = 500000 (50 ha)
             }
-    mask = f_get_mask_pixel_filtering(par.path_out[region].n2000, 'change_map', par3)
+    mask = f_get_mask_pixel_filtering(change_map, 'change_map', par3)
 
     # remove holes in forest anomalies by area
     print("filtering holes in forest anomalies")
@@ -312,64 +502,34 @@ def f_apply_raster_filter(par, region):
             }
     mask_hole   = f_get_mask_pixel_filtering(mask_inv, 'change_map', par3)
     change_mask = np.maximum(mask, mask_hole)
-
-    # write output
-    print("writing output to nc")
-    reference = path3.pre
-    path      = par.path_out[region].n2000
-    group     = '/3i3d'
-    data_dict = {'change_map_filtered': change_mask}
-    f_write_nc(reference, path, group, data_dict, crs='epsg:4326', metadata_dict=meta3)
-
-
-def polygonize(raster_path, band_name, out_path):
-    # Read input band with Rasterio
-
-    path_band = 'netcdf:' + raster_path + ':{}'.format(band_name)
-    with rio.open(path_band) as src:
-        crs = src.crs.to_wkt()
-        src_band = src.read().astype(np.uint8)
-        # Keep track of unique pixel values in the input band
-        #unique_values = np.unique(src_band)
-        # Polygonize with Rasterio. `shapes()` returns an iterable
-        # of (geom, value) as tuples
-        shapes = list(rasterio.features.shapes(src_band, transform=src.transform))
-
-
-    shp_schema = {
-        'geometry': 'Polygon',
-        'properties': {}
-    }
-
-    # Get a list of all polygons for a given pixel value
-    # and create a MultiPolygon geometry with shapely.
-    # Then write the record to an output shapefile with fiona.
-    # We make use of the `shape()` and `mapping()` functions from
-    # shapely to translate between the GeoJSON-like dict format
-    # and the shapely geometry type.
-    #output_driver = 'ESRI Shapefile'
-    output_driver = "GeoJSON"
-    with fiona.open(out_path, 'w', output_driver, shp_schema, crs) as shp:
-        polygons = [shape(geom) for geom, value in shapes
-                    if value == 1]
-        for pol in polygons:
-            pol1 = Polygon(pol)
-            if not pol1.is_valid:
-                clean = pol1.buffer(0.0)
-                if clean.is_valid and clean.geom_type == 'Polygon':
-                    pol1 = clean
-                else:
-                    continue
-            shp.write({
-                'geometry': mapping(pol1),
-                'properties': {}
-            })
+    return change_mask
 
 
+def f_get_geotransform(reference):
+    "geotransform and crs of a netcdf"
+    with rioxarray.open_rasterio(reference) as ref:
+        return ref.rio.transform(), ref.rio.crs
 
 
 # -- PARAMETERIZATION --------------------------------------------------------
-def f_get_parameters(mon_in):
+def f_get_static_paths(code_region, dir_parent='../'):
+    "paths of the static inputs of a region: forest mask and n2000 sites"
+    forest_mask_name = f'dati_aggiuntivi/STC_forest_mask_{code_region}.tif'
+    path_forest_mask = os.path.join(dir_parent, forest_mask_name)
+    name_n2000_sites = f'dati_aggiuntivi/STC_N2000_sites_{code_region}.shp'
+    path_n2000_sites = os.path.join(dir_parent, name_n2000_sites)
+    return path_forest_mask, path_n2000_sites
+
+
+def warm_static_layers():
+    "build (or load) the cached static layers of every managed region"
+    for code_region in REGIONS:
+        paths = f_get_static_paths(code_region)
+        if all(os.path.exists(x) for x in paths):
+            cache.get_static_layers(*paths, region=code_region)
+
+
+def f_get_parameters(mon_in, dir_tmp=None):
     dir_data = '../data/'
     dir_parent = '../'
     data_rif = mon_in['data_rif']
@@ -377,10 +537,7 @@ def f_get_parameters(mon_in):
     date_end = mon_in['data_fin_mon']
 
     par = DD()
-    par.region3 = { # unused. used for check purposes
-            10: 'Umbria',
-            12: 'Lazio'
-            }
+    par.region3 = REGIONS # unused. used for check purposes
     code_region = int(mon_in['id_regione'])
 
 
@@ -395,13 +552,8 @@ def f_get_parameters(mon_in):
         if x not in fname2:
             raise FileNotFoundError(f'{x} not found in data directory')
 
-    # forest mask
-    forest_mask_name = f'dati_aggiuntivi/STC_forest_mask_{code_region}.tif'
-    path_forest_mask = os.path.join(dir_parent, forest_mask_name)
-
-    # n2000 sites
-    name_n2000_sites = f'dati_aggiuntivi/STC_N2000_sites_{code_region}.shp'
-    path_n2000_sites = os.path.join(dir_parent, name_n2000_sites)
+    # forest mask and n2000 sites
+    path_forest_mask, path_n2000_sites = f_get_static_paths(code_region, dir_parent)
 
     # PMF export
     name_fmp = mon_in['path_file_fmp']  # from json request
@@ -430,7 +582,7 @@ def f_get_parameters(mon_in):
     # ---------------------------------------
     # build path dictionary (input and output)
     region = code_region
-    dir_tmp = dir_data + 'tmp/'
+    dir_tmp = dir_tmp or dir_data + 'tmp/'
     dir_output = dir_data + 'output/'
     os.makedirs(dir_tmp, exist_ok=True)
     os.makedirs(dir_output, exist_ok=True)
@@ -527,17 +679,92 @@ class fake_logger():
         print(x)
 
 
-# -- MAIN FUNCTION -----------------------------------------------------------
-def main(mon_input, my_logger):
+# 3i3d, filtering and polygonization of the forest disturbances, and statistics of the
+# N2000 sites (rao_q_lin.get_site_stats). Returns the site statistics
+def f_get_disturbances(par, region, static, in_path3, forest_mask):
+    out_path = par.path_out[region].n2000
+    meta3 = par.n2000[region].meta3
+    # the maps stay in memory from 3i3d to filtering and polygonization:
+    # the netcdf is written once and never read back
+    transform, crs = f_get_geotransform(in_path3['pre'])
+    if MON_BLOCK_ROWS:
+        # streaming: blocks of MON_BLOCK_ROWS rows read, processed and written
+        logger.info(f"applying 3i3d algorithm (blocks of {MON_BLOCK_ROWS} rows)")
+        change_map = f_3i3d_streaming(in_path3, forest_mask, 224, out_path, meta3, MON_BLOCK_ROWS)
+        data3 = dict()  # magnitude and change_map already written
+    else:
+        logger.info("data reading")
+        data3, reference = f_get_dataset_nc_xarray(in_path3, forest_mask)
+        logger.info("applying 3i3d algorithm")
+        magnitude, change_map = f_3i3d_fused(data3, 224)
+
+        name2 = ['magnitude', 'change_map']
+        data3 = dict(zip(name2, [magnitude.astype(np.float32), change_map.astype(np.uint8)])) # data dictionary
+        change_map = data3['change_map']
         if TESTING == 1:
-            pickle.dump(mon_input, open('mon_input.pkl', 'wb'))
+            # saved in the temporary directory of the request (never shared by the jobs)
+            for name, obj in (('reference', reference), ('data3', data3), ('meta3', meta3)):
+                with open(os.path.join(par.dir_tmp, f'{name}.pkl'), 'wb') as f:
+                    pickle.dump(obj, f)
+
+    logger.info("post-processing: raster cleanup")
+    # postprocessing: raster cleaning
+    change_map_filtered = f_filter_change_map(change_map)
+    del change_map
+
+    logger.info("writing 3i3d maps")
+    data3['change_map_filtered'] = change_map_filtered
+    f_write_nc(
+            reference=in_path3['pre'],
+            out_path=out_path,
+            group='/3i3d',
+            data_dict=data3,
+            metadata_dict=meta3
+            )
+    del data3
+    logger.info("writing 3i3d maps complete")
+
+    logger.info("post-processing: polygonize")
+    # polygonize the disturbances (components of the change map) in parallel,
+    # convert to epsg:3035 and compute area (m2)
+    vectorize.polygonize_sparse(
+            change_map_filtered,
+            transform,
+            crs,
+            par.path_tmp[region].n2000_geojson,
+            dst_crs='EPSG:3035',
+            pool=rao_q_lin.get_process_pool(),
+            dir_tmp=par.dir_tmp,
+            )
+    logger.info("complete: monitoring of forest disturbances")
+
+    # biodiversity indicator (Nat2): statistics of the N2000 sites
+    logger.info("start: compute biodiversity indicator (Nat2)")
+    site_stats = rao_q_lin.get_site_stats(
+        raster_input      = par.path_data[region].sentinel2.now,
+        disturbances_mask = par.path_out[region].n2000,
+        output_dir        = par.dir_tmp,
+        static            = static,
+        disturbances      = (change_map_filtered, crs, transform),
+    )
+    logger.info("complete: compute biodiversity indicator (Nat2)")
+    return site_stats
+
 
+# -- MAIN FUNCTION -----------------------------------------------------------
+def main(mon_input, my_logger, dir_tmp=None):
+        '''
+        dir_tmp: directory of the temporary files of the request (None: ../data/tmp/)
+        '''
         #global logger
         global logger
         logger = my_logger
         logger.info("reading parameters")
 
-        par = f_get_parameters(mon_input)
+        par = f_get_parameters(mon_input, dir_tmp)
+        if TESTING == 1:
+            with open(os.path.join(par.dir_tmp, 'mon_input.pkl'), 'wb') as f:
+                pickle.dump(mon_input, f)
 
         # -- LOGGING ---------------------------
         #logging.basicConfig(filename = par.log_path,
@@ -554,80 +781,70 @@ def main(mon_input, my_logger):
         logger.info("=== PROCESSING N2000 REQUEST ===")
         logger.info(f"start: {mon_start_str}")
         region = int(mon_input['id_regione'])
-        fmask = par.path_data[region].forest_mask
-        forest_mask = f_get_mask(fmask)
+        static = cache.get_static_layers(
+                par.path_data[region].forest_mask,
+                par.path_data[region].n2000_sites,
+                region=region,
+                )
+        forest_mask = static.fmask
         in_path3 = {
                 'pre': par.path_data[region].sentinel2.pre,
                 'now': par.path_data[region].sentinel2.now,
                 'post': par.path_data[region].sentinel2.post,
         }
-        logger.info("data reading")
-        data3, reference = f_get_dataset_nc_xarray(in_path3, forest_mask)
-        logger.info("applying 3i3d algorithm")
-        magnitude, change_map = f_3i3d(data3, 224)
-        logger.info("writing 3i3d maps")
-
-        name2 = ['magnitude', 'change_map']
-        data3 = dict(zip(name2, [magnitude.astype(np.float32), change_map.astype(np.uint8)])) # data dictionary
         out_path = par.path_out[region].n2000
-        meta3 = par.n2000[region].meta3
-        if TESTING == 1:
-            pickle.dump(reference, open('reference.pkl', 'wb'))
-            pickle.dump(data3, open('data3.pkl', 'wb'))
-            pickle.dump(meta3, open('meta3.pkl', 'wb'))
-        f_write_nc(
-                reference=reference,
-                out_path=out_path,
-                group='/3i3d',
-                data_dict=data3,
-                metadata_dict=meta3
+
+        # the disturbances and the Rao's Q statistics depend only on the satellite and
+        # static inputs: a request with the same inputs (e.g. only a new FMP export)
+        # reuses them and recomputes only the alert and the PAF statistics
+        result_key = cache.get_result_key(
+                [in_path3['pre'], in_path3['now'], in_path3['post'],
+                 par.path_data[region].forest_mask, par.path_data[region].n2000_sites],
+                region=region,
+                last_year=par.last_year,
+                version=MON_VERSION,
                 )
-        logger.info("writing 3i3d maps complete")
-
-        logger.info("post-processing: raster cleanup")
-        # postprocessing: raster cleaning
-        f_apply_raster_filter(par, region)
-
-        logger.info("post-processing: polygonize")
-        # polygonize
-        polygonize(
-                raster_path=par.path_out[region].n2000,
-                band_name='change_map_filtered',
-                out_path=par.path_tmp[region].n2000_geojson_epsg4326
+        tables = cache.load_results(
+                result_key,
+                files={
+                    'ecological_disturbances.nc': out_path,
+                    'disturbances.geojson': par.path_tmp[region].n2000_geojson,
+                },
+                tables=['site_stats'],
                 )
-
-        # convert to epsg:3035 and compute area (m2)
-        gdf = gpd.read_file(par.path_tmp[region].n2000_geojson_epsg4326)
-        gdf.to_crs(epsg=3035, inplace=True)
-        gdf['area_m2'] = gdf['geometry'].area
-        gdf.to_json()
-        gdf.to_file(
-            par.path_tmp[region].n2000_geojson,
-            driver='GeoJSON',
-        )
-        os.remove(par.path_tmp[region].n2000_geojson_epsg4326)  # cleanup temporary files
-        logger.info("complete: monitoring of forest disturbances")
+        if tables is not None:
+            logger.info(f"unchanged inputs: using the cached results {result_key}")
+            site_stats = tables['site_stats']
+        else:
+            site_stats = f_get_disturbances(par, region, static, in_path3, forest_mask)
+            cache.save_results(
+                    result_key,
+                    files={
+                        'ecological_disturbances.nc': out_path,
+                        'disturbances.geojson': par.path_tmp[region].n2000_geojson,
+                    },
+                    tables={'site_stats': site_stats},
+                    )
 
         # alert for forest disturbancies
         logger.info("start: forest cut alert")
         alert.add_alert_info(
             par.path_data[region].fmp,
             par.path_tmp[region].n2000_geojson,
-            par.path_out[region].alert
+            par.path_out[region].alert,
+            pool=rao_q_lin.get_process_pool(),
         )
         logger.info("complete: forest cut alert")
 
-        # biodiversity indicator (Nat2)
-        logger.info("start: compute biodiversity indicator (Nat2)")
-        rao_q_lin.main(
-            raster_input      = par.path_data[region].sentinel2.now,
-            n2000_input       = par.path_data[region].n2000_sites,
-            forest_mask       = par.path_data[region].forest_mask,
-            disturbances_mask = par.path_out[region].n2000,
-            path_paf_export   = par.path_data[region].fmp,
-            output_dir        = par.dir_tmp,
-            path_nat2         = par.path_out[region].biodiv,
+        # biodiversity indicator (Nat2): PAF statistics
+        logger.info("start: export biodiversity indicator (Nat2)")
+        rao_q_lin.export_nat2(
+            site_stats,
+            static.sites,
+            par.path_data[region].fmp,
+            par.path_out[region].biodiv,
         )
+        logger.info("complete: export biodiversity indicator (Nat2)")
         mon_end = datetime.now()
         mon_end_str = str(mon_end)
         duration = (mon_end - mon_start).total_seconds()
@@ -7,25 +7,44 @@
 import numpy as np
 import pandas as pd
 import math
-from itertools import combinations
+from functools import partial
 import rasterio
-from rasterio.merge import merge
+from rasterio.features import geometry_mask
+from rasterio.transform import array_bounds
 #import xarray as xr
 import rioxarray
 import os
-import copy
 from rasterio.mask import mask as rio_mask
 import geopandas as gpd
 import ray
-from rasterstats import zonal_stats
+import zonal
+import cache
+import intersect
 from tqdm import tqdm
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import tempfile
 import psutil
 
 
 TEST = False
 
+# max memory (bytes) used by the pair distances of a block
+RAOQ_BLOCK_MEMORY = 256 * 2**20
+# smallest moving window computed with the incremental algorithm (method "auto")
+RAOQ_INCREMENTAL_WINDOW = 7
+# object store memory (bytes) reserved by Ray
+RAY_OBJECT_STORE_MEMORY = 256 * 10**6
+# execution backend of Rao's Q: "serial", "process" or "ray"
+RAOQ_BACKEND = os.environ.get('RAOQ_BACKEND', 'process')
+# resources left to the other processes of the container
+RAOQ_RESERVED_CPUS = 2
+RAOQ_RESERVED_RAM = 2 * 10**9
+# max workers of the pool. 0: no limit (set by the job processes sharing the host, see jobs.py)
+RAOQ_MAX_WORKERS = 0
+
 
 # --- RAO Q ---
 # From https://github.com/mmadrz/PaRaVis.git
@@ -73,111 +92,352 @@ def canberra_dist(pair_list):
 # Compute Minkowski distance between two vectors with parameter p
 def minkowski_dist(pair_list, p_minkowski):
     return sum(
-        [(abs(x[0] - x[1]) ** p_minkowski) ** (1 / p_minkowski) for x in pair_list]
-    )
+        [abs(x[0] - x[1]) ** p_minkowski for x in pair_list]
+    ) ** (1 / p_minkowski)
+
+
+# --- BATCHED DISTANCES ---
+# Same distances of the functions above, computed at once on arrays of pairs.
+# a, b: arrays of shape (..., n_bands); the distance is reduced on the last axis
+def euclidean_kernel(a, b):
+    return np.sqrt(np.sum((a - b) ** 2, axis=-1))
+
+
+def manhattan_kernel(a, b):
+    return np.sum(np.abs(a - b), axis=-1)
+
+
+def chebyshev_kernel(a, b):
+    return np.max(np.abs(a - b), axis=-1)
+
+
+def jaccard_kernel(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(1 - (np.minimum(a, b) / np.maximum(a, b)), axis=-1)
+
+
+def canberra_kernel(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(np.abs(a - b) / (np.abs(a) + np.abs(b)), axis=-1)
+
+
+def minkowski_kernel(a, b, p_minkowski):
+    return np.sum(np.abs(a - b) ** p_minkowski, axis=-1) ** (1 / p_minkowski)
+
+
+DISTANCE_KERNELS = {
+    "euclidean": euclidean_kernel,
+    "manhattan": manhattan_kernel,
+    "chebyshev": chebyshev_kernel,
+    "jaccard": jaccard_kernel,
+    "canberra": canberra_kernel,
+    "minkowski": minkowski_kernel,
+}
 
 
+# Get the batched distance function from its name (case insensitive)
+def get_distance_kernel(distance_m, p_minkowski=2):
+    name = distance_m.lower()
+    if name not in DISTANCE_KERNELS:
+        raise NotImplementedError(f'Distance {distance_m} is not managed')
+    kernel = DISTANCE_KERNELS[name]
+    if name == "minkowski":
+        return partial(kernel, p_minkowski=p_minkowski)
+    return kernel
 
-# Convert TIFF input(s) to NumPy array
-def tiff_to_np(tiff_input):
-    matrix1 = tiff_input.read()
-    matrix1 = matrix1.reshape((matrix1.shape[1]), matrix1.shape[2])
+
+
+# Convert a (multi-band) TIFF input to a list of NumPy arrays (one for each band)
+def tiff_to_np_bands(tiff_input):
+    matrix3 = tiff_input.read().astype(np.float64)
     minNum = -999
-    matrix1[matrix1 == minNum] = np.nan
-    return matrix1
+    matrix3[matrix3 == minNum] = np.nan
+    return list(matrix3)
 
 
-def extract_win_1d(data1d, row, col, shape1, window, width):
-    data = []
-    for i in range(window):
-        row1d_index = (row + i - width) * shape1
-        start = row1d_index + col - width
-        end =  row1d_index + col + width + 1
-        data.append(data1d[start:end])
-    return np.concatenate(data)
+# Pair offset table of a moving window: indices (i, j), with i < j, of every pair
+# of pixels in the flattened window. Same ordering of itertools.combinations
+def pair_index(window):
+    return np.triu_indices(window ** 2, k=1)
 
 
-@ray.remote
-def compute_raoq_range(
+# Compute Rao's Q for every pixel of a block of the padded raster in one shot.
+# trasterm: padded raster of shape (rows, cols, n_bands), one vector per pixel.
+# rows and columns are expressed in padded raster coordinates (as in parallel_raoq)
+def raoq_block(
+    trasterm,
+    row_start,
+    row_end,
+    col_start,
+    col_end,
+    window,
+    distance_m,
+    na_tolerance,
+    p_minkowski=2,
+):
+    width = int(
+        (window - 1) / 2
+    )  # Number of neighbors from the central pixel to the edge of the window
+    n_rows = row_end - row_start
+    n_cols = col_end - col_start
+    n_bands = trasterm.shape[2]
+
+    # one flattened moving window for each pixel of the block: (n_rows, n_cols, window**2, n_bands)
+    block = trasterm[row_start - width : row_end + width, col_start - width : col_end + width]
+    data = np.lib.stride_tricks.sliding_window_view(block, (window, window), axis=(0, 1))
+    data = data.reshape(n_rows, n_cols, n_bands, window ** 2).transpose(0, 1, 3, 2)
+
+    # a pixel is skipped if any band does not have enough valid values in the window
+    borderCondition = np.any(
+        np.sum(np.invert(np.isnan(data)), axis=2)
+        < np.power(window, 2) - ((np.power(window, 2)) * na_tolerance),
+        axis=-1,
+    )
+    raoq_values = np.full((n_rows, n_cols), np.nan)
+    data = data[np.invert(borderCondition)]  # (pixels, window**2, n_bands)
+    n_pixels = data.shape[0]
+    if n_pixels == 0:
+        return raoq_values
+
+    # distances of all the window pairs are computed for chunks of pixels,
+    # bounding the size of the (pixels, n_pairs, n_bands) pair tensor
+    distance = get_distance_kernel(distance_m, p_minkowski)
+    ix, jx = pair_index(window)
+    chunk = max(1, int(RAOQ_BLOCK_MEMORY // (len(ix) * n_bands * 8 * 3)))
+    values = np.empty(n_pixels)
+    for start in range(0, n_pixels, chunk):
+        vectors = data[start : start + chunk]
+        vout = distance(np.take(vectors, ix, axis=1), np.take(vectors, jx, axis=1))
+
+        # Rescale the computed distances and calculate Rao's Q value
+        vout_rescaled = vout * 2
+        vout_rescaled = vout_rescaled / window**4
+        values[start : start + chunk] = np.nansum(vout_rescaled, axis=-1)
+    raoq_values[np.invert(borderCondition)] = values
+    return raoq_values
+
+
+# Moving sum of `size` consecutive elements along axis (0 or 1) of arr: each step
+# adds the entering row/column and subtracts the leaving one (through a running sum)
+def running_sum(arr, size, axis):
+    arr = np.moveaxis(arr, axis, 0)
+    csum = np.cumsum(arr, axis=0)
+    out = csum[size - 1 :].copy()
+    out[1:] -= csum[:-size]
+    return np.moveaxis(out, 0, axis)
+
+
+# Compute Rao's Q for every pixel of a block of the padded raster (same arguments
+# and result of raoq_block) with an incremental algorithm suited for large windows.
+# The pairs of a window are grouped by their offset (dr, dc): for each offset the
+# distance map d(x, x + offset) is computed once for the whole block, and the sum
+# of the pairs that fall in each window is updated while the window slides (running
+# sums along rows and columns). Cost is O(window**2) per pixel instead of O(window**4)
+def raoq_block_incremental(
+    trasterm,
     row_start,
     row_end,
     col_start,
     col_end,
-    data1d,
-    shape1,
     window,
     distance_m,
     na_tolerance,
+    p_minkowski=2,
 ):
     width = int(
         (window - 1) / 2
     )  # Number of neighbors from the central pixel to the edge of the window
-    raoq_values = []  # Initialize a list to store computed Rao's Q values
+    block = trasterm[row_start - width : row_end + width, col_start - width : col_end + width]
+    n_rows = block.shape[0]
+    n_cols = block.shape[1]
+
+    # a pixel is skipped if any band does not have enough valid values in the window
+    valid = np.invert(np.isnan(block)).astype(np.int64)
+    n_valid = running_sum(running_sum(valid, window, 0), window, 1)
+    borderCondition = np.any(
+        n_valid < np.power(window, 2) - ((np.power(window, 2)) * na_tolerance),
+        axis=-1,
+    )
 
+    # sum of the distances of all the pairs of each window, offset by offset
+    distance = get_distance_kernel(distance_m, p_minkowski)
+    pair_sum = np.zeros(borderCondition.shape)
+    for dr in range(window):
+        for dc in range(-window + 1, window):
+            if dr == 0 and dc <= 0:
+                continue  # each pair is counted once
+            if dc >= 0:
+                dist = distance(block[: n_rows - dr, : n_cols - dc], block[dr:, dc:])
+            else:
+                dist = distance(block[: n_rows - dr, -dc:], block[dr:, : n_cols + dc])
+            dist[np.isnan(dist)] = 0  # as np.nansum on the pair distances
+            pair_sum += running_sum(running_sum(dist, window - dr, 0), window - abs(dc), 1)
 
-    # iterate through rows and columns
-    for rw in range(row_start, row_end):
-        for cl in range(col_start, col_end):
+    # Rescale the computed distances and calculate Rao's Q value
+    raoq_values = pair_sum * 2 / window**4
+    raoq_values[borderCondition] = np.nan
+    return raoq_values
 
-            # Create a list of border condition results for all input arrays
-            #data1d = trastersm_list.flatten()
-            data = [extract_win_1d(data1d, rw, cl, shape1, window, width)]
 
-            borderCondition = (
-                np.sum(np.invert(np.isnan(data)))
-                < np.power(window, 2) - ((np.power(window, 2)) * na_tolerance)
-            )
+RAOQ_METHODS = {
+    "pairs": raoq_block,
+    "incremental": raoq_block_incremental,
+}
 
-            # Check if any array satisfies the border condition
-            if borderCondition:
-                raoq_values.append(np.nan)
-            else:
-                # Extract sub-windows for all input arrays
-
-                # Generate combinations of sub-window pairs
-                vcomb = list(
-                    combinations(range(data[0].shape[0]), 2)
-                )
-                lpair2 = np.take(data, vcomb).tolist()
-                vout = [euclidean_dist([x]) for x in lpair2]
-
-
-
-                # Calculate  selected distances for all sub-window pairs
-                #vout = []
-                #check = []
-                #for comb in vcomb:
-                #    lpair = [[x[comb[0]], x[comb[1]]] for x in lv]
-                #    check.append(lpair)
-                #    if distance_m == "euclidean":
-                #        out = euclidean_dist(lpair)
-                #    elif distance_m == "manhattan":
-                #        out = manhattan_dist(lpair)
-                #    elif distance_m == "chebyshev":
-                #        out = chebyshev_dist(lpair)
-                #    elif distance_m == "canberra":
-                #        out = canberra_dist(lpair)
-                #    elif distance_m == "Jaccard":
-                #        out = jaccard_dist(lpair)
-                #    vout.append(out)
-
-                # Rescale the computed distances and calculate Rao's Q value
-                vout_rescaled = [x * 2 for x in vout]
-                vout_rescaled[:] = [x / window**4 for x in vout_rescaled]
-                raoq_value = np.nansum(vout_rescaled)
-                raoq_values.append(raoq_value)
-
-    # Return the results for the specified row and column range
-    return row_start, row_end, col_start, col_end, raoq_values
 
-def parallel_raoq(
-    data_input,
-    output_path,
+# Get the block function computing Rao's Q. method "auto": the incremental
+# algorithm is used for windows >= RAOQ_INCREMENTAL_WINDOW
+def get_raoq_method(window, method="auto"):
+    if method == "auto":
+        method = "incremental" if window >= RAOQ_INCREMENTAL_WINDOW else "pairs"
+    if method not in RAOQ_METHODS:
+        raise NotImplementedError(f'Rao\'s Q method {method} is not managed')
+    return RAOQ_METHODS[method]
+
+
+# --- SHARED MEMORY ---
+# NumPy arrays shared by the workers through memory-mapped .npy files: the raster is
+# written once in the page cache and the workers map it from its path (handle), with
+# no copy or serialization. Files are used instead of /dev/shm, which is only 64 MB
+# in a default docker container
+
+# Create a shared array. Returns the array and the handle used to attach to it
+def create_shared_array(shape, dtype=np.float64, dir_tmp=None):
+    fd, handle = tempfile.mkstemp(prefix='tmp_shared_', suffix='.npy', dir=dir_tmp)
+    os.close(fd)
+    arr = np.lib.format.open_memmap(handle, mode='w+', dtype=dtype, shape=shape)
+    return arr, handle
+
+
+# Attach to a shared array created by another process
+def attach_shared_array(handle):
+    return np.load(handle, mmap_mode='r+')
+
+
+# Release a shared array created with create_shared_array (existing maps stay valid)
+def release_shared_array(handle):
+    os.remove(handle)
+
+
+# Compute Rao's Q of a row/column range of the shared padded raster and write it
+# in the shared output (worker function of the "process" and "ray" backends)
+def compute_raoq_range(
+    row_start,
+    row_end,
+    col_start,
+    col_end,
+    trasterm_handle,
+    raoq_handle,
+    window,
+    distance_m,
+    na_tolerance,
+    p_minkowski,
+    method,
+):
+    w = int((window - 1) / 2)
+    trasterm = attach_shared_array(trasterm_handle)
+    raoq = attach_shared_array(raoq_handle)
+    raoq_values = get_raoq_method(window, method)(
+        trasterm,
+        row_start,
+        row_end,
+        col_start,
+        col_end,
+        window,
+        distance_m,
+        na_tolerance,
+        p_minkowski,
+    )
+    # Write the results for the specified row and column range in the shared output
+    raoq[
+        row_start - w : row_end - w, col_start - w : col_end - w
+    ] = raoq_values
+    return row_start, row_end, col_start, col_end
+
+
+compute_raoq_range_ray = ray.remote(compute_raoq_range)
+
+
+# --- EXECUTION BACKENDS ---
+# serial : blocks are computed in the calling process
+# process: blocks are computed by a pool of processes (concurrent.futures)
+# ray    : blocks are computed by Ray tasks
+# Pools are created once and kept warm across requests (see start_backend)
+RAOQ_BACKENDS = ("serial", "process", "ray")
+_process_pool = None
+
+
+# Estimated peak memory (bytes) of a worker computing one block
+def get_worker_memory(batch_size, window, n_bands):
+    block_pixels = (batch_size + window - 1) ** 2
+    return RAOQ_BLOCK_MEMORY + block_pixels * window ** 2 * n_bands * 8 * 2
+
+
+# Number of workers: all the CPUs but RAOQ_RESERVED_CPUS (at most RAOQ_MAX_WORKERS),
+# bounded by the available memory (less RAOQ_RESERVED_RAM) divided by the memory
+# required by each worker
+def get_worker_count(worker_memory=None):
+    if worker_memory is None:
+        worker_memory = get_worker_memory(100, 3, 1)
+    num_cpus = max(multiprocessing.cpu_count() - RAOQ_RESERVED_CPUS, 1)
+    if RAOQ_MAX_WORKERS:
+        num_cpus = min(num_cpus, RAOQ_MAX_WORKERS)
+    ram_avail = psutil.virtual_memory().available - RAOQ_RESERVED_RAM
+    num_mem = int(ram_avail // worker_memory)
+    return max(min(num_cpus, num_mem), 1)
+
+
+# Start the execution backend (no-op if it is already running)
+def start_backend(backend=None):
+    global _process_pool
+    backend = backend or RAOQ_BACKEND
+    if backend not in RAOQ_BACKENDS:
+        raise NotImplementedError(f'Rao\'s Q backend {backend} is not managed')
+    if backend == "process" and _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=get_worker_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    elif backend == "ray" and not ray.is_initialized():
+        ray.init(
+            num_cpus=get_worker_count(), object_store_memory=RAY_OBJECT_STORE_MEMORY
+        )
+
+
+# Get the process pool (started if needed), shared with the other parallel steps.
+# None if the backend is not "process": the other steps then run in this process
+def get_process_pool(backend=None):
+    backend = backend or RAOQ_BACKEND
+    if backend != "process":
+        return None
+    start_backend(backend)
+    return _process_pool
+
+
+# Stop the execution backends
+def stop_backend():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown()
+        _process_pool = None
+    if ray.is_initialized():
+        ray.shutdown()
+
+
+# Compute Rao's Q of a list of aligned 2D arrays (one for each band). Returns the
+# Rao's Q array. Blocks without valid pixels (e.g. out of the forest mask) are skipped
+def compute_raoq(
+    numpy_data,
     distance_m="euclidean",
     window=9,
     na_tolerance=0.0,
     batch_size=100,
+    backend=None,
+    p_minkowski=2,
+    method="auto",
+    dir_tmp=None,
 ):
+    backend = backend or RAOQ_BACKEND
     if window % 2 == 1:
         w = int((window - 1) / 2)
     else:
@@ -185,29 +445,38 @@ def parallel_raoq(
             "The size of the moving window must be an odd number. Exiting..."
         )
 
-    # Convert input data to NumPy arrays
-    numpy_data = [tiff_to_np(data) for data in data_input]
-
-    # Initialize raoq array with NaN values
-    raoq = np.zeros(shape=numpy_data[0].shape)
+    get_distance_kernel(distance_m, p_minkowski)  # fail early on unknown distances
+    raoq_function = get_raoq_method(window, method)
+    start_backend(backend)
+
+    # Initialize raoq array with NaN values (shared with the workers if not serial)
+    mat = numpy_data[0]
+    shape_pad = (mat.shape[0] + 2 * w, mat.shape[1] + 2 * w, len(numpy_data))
+    shared = backend != "serial"
+    if shared:
+        raoq, raoq_handle = create_shared_array(mat.shape, dir_tmp=dir_tmp)
+        trasterm, trasterm_handle = create_shared_array(shape_pad, dir_tmp=dir_tmp)
+    else:
+        raoq = np.zeros(shape=mat.shape)
+        trasterm = np.zeros(shape=shape_pad)
     raoq[:] = np.nan
 
-    # Create a list of transformed arrays for each input
-    trastersm_list = []
-    for mat in numpy_data:
-        trasterm = np.zeros(shape=(mat.shape[0] + 2 * w, mat.shape[1] + 2 * w))
-        trasterm[:] = np.nan
-        trasterm[w : w + mat.shape[0], w : w + mat.shape[1]] = mat
-        trastersm_list.append(trasterm)
+    # Stack all the bands in a NaN padded raster: each pixel is a vector of n_bands values
+    trasterm[:] = np.nan
+    for ix, mat in enumerate(numpy_data):
+        trasterm[w : w + mat.shape[0], w : w + mat.shape[1], ix] = mat
+    del numpy_data
 
     # Adjust batch size to fit all pixels
-    max_rows = numpy_data[0].shape[0] - 2 * w + 1
-    max_cols = numpy_data[0].shape[1] - 2 * w + 1
-    batch_size = min(batch_size, max_rows, max_cols)
+    if raoq_function is raoq_block_incremental:
+        batch_size = max(batch_size, 4 * window)  # amortize the window border of each block
+    max_rows = raoq.shape[0] - 2 * w + 1
+    max_cols = raoq.shape[1] - 2 * w + 1
+    batch_size = max(min(batch_size, max_rows, max_cols), 1)
 
     # Adjust row and column batches
-    rows = numpy_data[0].shape[0]
-    cols = numpy_data[0].shape[1]
+    rows = raoq.shape[0]
+    cols = raoq.shape[1]
     row_batches = range(w, rows + w, batch_size)
     col_batches = range(w, cols + w, batch_size)
 
@@ -219,37 +488,100 @@ def parallel_raoq(
     if col_batches[-1] != cols + w:
         col_batches.append(cols + w)
 
-    data1d = trastersm_list[0].flatten()
-    shape1 = trastersm_list[0].shape[1]
-    # Use Ray to parallelize the computation
-    ray_results = []
-    for row_start, row_end in zip(row_batches[:-1], row_batches[1:]):
-        for col_start, col_end in zip(col_batches[:-1], col_batches[1:]):
-            pixel_data = (
-                row_start,
-                row_end,
-                col_start,
-                col_end,
-                data1d,
-                shape1,
-                window,
-                distance_m,
-                na_tolerance,
-            )
-            # ray_results.append(compute_raoq_range(*pixel_data))
-            ray_results.append(compute_raoq_range.remote(*pixel_data))
-
-
-    # Update raoq array with the computed values
-    with tqdm(total=len(ray_results)) as pbar:
-        for result in ray_results:
-            row_start, row_end, col_start, col_end, raoq_values = ray.get(result)
-            raoq[
-                row_start - w : row_end - w, col_start - w : col_end - w
-            ] = np.array(raoq_values).reshape(
-                row_end - row_start, col_end - col_start
-            )
-            pbar.update(1)
+    # Compute Rao's Q block by block. Parallel workers receive only the handles of
+    # the shared input and output arrays and write their block in place
+    try:
+        results = []
+        for row_start, row_end in zip(row_batches[:-1], row_batches[1:]):
+            for col_start, col_end in zip(col_batches[:-1], col_batches[1:]):
+                # all NaN windows give NaN (unless every NaN is tolerated)
+                block = trasterm[row_start - w : row_end + w, col_start - w : col_end + w]
+                if na_tolerance < 1 and np.isnan(block).all():
+                    continue
+                if shared:
+                    pixel_data = (
+                        row_start,
+                        row_end,
+                        col_start,
+                        col_end,
+                        trasterm_handle,
+                        raoq_handle,
+                        window,
+                        distance_m,
+                        na_tolerance,
+                        p_minkowski,
+                        method,
+                    )
+                    if backend == "ray":
+                        results.append(compute_raoq_range_ray.remote(*pixel_data))
+                    else:
+                        results.append(_process_pool.submit(compute_raoq_range, *pixel_data))
+                else:
+                    raoq[
+                        row_start - w : row_end - w, col_start - w : col_end - w
+                    ] = raoq_function(
+                        trasterm,
+                        row_start,
+                        row_end,
+                        col_start,
+                        col_end,
+                        window,
+                        distance_m,
+                        na_tolerance,
+                        p_minkowski,
+                    )
+
+        # Wait for the workers
+        with tqdm(total=len(results)) as pbar:
+            for result in results:
+                if backend == "ray":
+                    ray.get(result)
+                else:
+                    result.result()
+                pbar.update(1)
+    except BrokenProcessPool:
+        # a worker died (e.g. out of memory): a new pool is started by the next call
+        stop_backend()
+        raise
+    finally:
+        if shared:
+            for result in results:
+                if backend == "process":
+                    result.cancel()
+            raoq = np.array(raoq)
+            release_shared_array(trasterm_handle)
+            release_shared_array(raoq_handle)
+
+    return raoq
+
+
+def parallel_raoq(
+    data_input,
+    output_path,
+    distance_m="euclidean",
+    window=9,
+    na_tolerance=0.0,
+    batch_size=100,
+    backend=None,
+    p_minkowski=2,
+    method="auto",
+):
+    # Convert input data to NumPy arrays (one for each band of each input)
+    numpy_data = []
+    for data in data_input:
+        numpy_data += tiff_to_np_bands(data)
+
+    raoq = compute_raoq(
+        numpy_data,
+        distance_m   = distance_m,
+        window       = window,
+        na_tolerance = na_tolerance,
+        batch_size   = batch_size,
+        backend      = backend,
+        p_minkowski  = p_minkowski,
+        method       = method,
+        dir_tmp      = os.path.dirname(output_path) or None,
+    )
 
     # Export the computed Rao's Q index as a TIFF file
     info = data_input[0].profile
@@ -264,6 +596,9 @@ def apply_raoq(
     window       = 3,
     na_tolerance = 0,
     batch_size   = 100,
+    backend      = None,
+    p_minkowski  = 2,
+    method       = "auto",
 ):
     # Initialize Ray
     # options=["euclidean", "manhattan", "chebyshev", "Jaccard", "canberra", "minkowski"],
@@ -278,6 +613,9 @@ def apply_raoq(
         window       = window,
         na_tolerance = na_tolerance,
         batch_size   = batch_size,
+        backend      = backend,
+        p_minkowski  = p_minkowski,
+        method       = method,
     )
 
 def reproject_geotiff(path_input, path_output, dst_crs):
@@ -306,6 +644,33 @@ def reproject_geotiff(path_input, path_output, dst_crs):
     return
 
 
+# Reproject an array (bands, rows, cols) to dst_crs, on the same grid computed by
+# reproject_geotiff or, if given, on the grid (dst_transform, dst_shape).
+# Returns the reprojected array and its transform
+def reproject_array(arr, src_crs, src_transform, dst_crs, nodata=None, dst_transform=None, dst_shape=None):
+    height, width = arr.shape[-2:]
+    if dst_transform is None:
+        transform, dst_width, dst_height = calculate_default_transform(
+            src_crs, dst_crs, width, height, *array_bounds(height, width, src_transform))
+    else:
+        transform = dst_transform
+        dst_height, dst_width = dst_shape
+    dst_arr = np.zeros(arr.shape[:-2] + (dst_height, dst_width), dtype=arr.dtype)
+    if nodata is not None:
+        dst_arr[:] = nodata
+    reproject(
+        source=arr,
+        destination=dst_arr,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        src_nodata=nodata,
+        dst_transform=transform,
+        dst_crs=dst_crs,
+        dst_nodata=nodata,
+        resampling=Resampling.nearest)
+    return dst_arr, transform
+
+
 def batch_clip_raster(src_vector, path_raster, id_field, prefix, output_dir):
     output_dict = dict()
     #src_vector = gpd.read_file(path_vector)
@@ -344,23 +709,21 @@ def extract_stats_dict(
     return stat_filt2
 
 
-def main(
+# Statistics of the N2000 sites computed from the satellite data: site and forest
+# area, disturbed area (m2) and Rao's Q. They do not depend on the PAF export
+def get_site_stats(
     raster_input,
-    n2000_input,
-    forest_mask,
     disturbances_mask,
-    path_paf_export,
     output_dir,
-    path_nat2,
+    static,  # static layers (cache.get_static_layers)
+    raoq_bands=None,  # bands used for a multivariate Rao's Q (e.g. ['B4', 'B8', 'B11', 'B12']). None: NDVI
+    disturbances=None,  # (change_map_filtered, crs, transform) in memory. None: read from disturbances_mask
 ):
-    # get n2000 bounding box (1 for each n2000)
-    n2000_gpd = gpd.read_file(n2000_input)
-    n2000_bbox = copy.deepcopy(n2000_gpd)
-    n2000_bbox.geometry = (
-        n2000_gpd
-        .buffer(20, cap_style='square')  # add 10 meters to each side of the bounding box
-        .envelope  # each row is the bounding box of the n2000 shapefile
-    )
+    # forest mask, n2000 sites and their bounding boxes (1 for each n2000), on the
+    # EPSG:3035 grid window covering all the sites
+    n2000_gpd = static.sites
+    grid_sites = static.footprint.shape
+    transform_sites = static.transform_sites
 
 
     # BUILD NDVI IMAGE
@@ -373,108 +736,48 @@ def main(
         meta = src.meta
         os.remove(p_tmp)
     with rioxarray.open_rasterio(raster_input) as f:
-        red = np.squeeze(f['B4'].data.astype(np.float32))
-        ired = np.squeeze(f['B8'].data.astype(np.float32))
-    ndvi_arr = (ired - red) / (ired + red)
+        if raoq_bands:
+            ndvi_arr = np.stack([np.squeeze(f[band].data.astype(np.float32)) for band in raoq_bands])
+        else:
+            red = np.squeeze(f['B4'].data.astype(np.float32))
+            ired = np.squeeze(f['B8'].data.astype(np.float32))
+            ndvi_arr = np.expand_dims((ired - red) / (ired + red), axis=0)
     meta.update(
         dtype=rasterio.float32,
         driver='GTiff',
+        count=ndvi_arr.shape[0],
     )
-    # apply forest mask to ndvi
-    with rasterio.open(forest_mask) as src:
-        mask = src.read(1)
-    ndvi_arr[mask == 0] = np.nan
-    ndvi_arr = np.expand_dims(ndvi_arr, axis=0)
-    output_path_ndvi = f'{output_dir}tmp_ndvi.tif'
-    with rasterio.open(output_path_ndvi, 'w', **meta) as dst:
-        dst.write(
-            ndvi_arr,
-        )
-
-    # REPROJECT NDVI IMAGE TO EPSG:3035
-    rds = rioxarray.open_rasterio(output_path_ndvi)
-    rds_3035 = rds.rio.reproject("EPSG:3035")
-    rds.close()
-    rds_3035.rio.to_raster(output_path_ndvi)
-    rds_3035.close()
-
-    # CLIP NDVI IMAGE FOR EACH N2000 SITE
-    ndvi3 = dict()
-    n2000_len = len(n2000_bbox)
-    with rasterio.open(output_path_ndvi) as ndvi_rio:
-        for ix in range(n2000_len):
-            coords = [n2000_bbox.iloc[ix]['geometry']]
-            code = n2000_bbox.iloc[ix]['codice']
-            clipped_array, clipped_transform = rio_mask(
-                dataset=ndvi_rio,
-                shapes=coords,
-                crop=True
-            )
-            out_meta = ndvi_rio.meta.copy()
-            out_meta.update({"driver": "GTiff",
-                             "height": clipped_array.shape[1],
-                             "width": clipped_array.shape[2],
-                             "transform": clipped_transform})
-            out_path = f"{output_dir}tmp_ndvi_{code}.tif"
-            with rasterio.open(out_path, "w", **out_meta) as dest:
-                dest.write(clipped_array)
-            ndvi3[code] = out_path
-    os.remove(output_path_ndvi)
-
-    # COMPUTE RAOQ FOR EACH N2000 SITE
-    # parallel processing
-    num_cpus = multiprocessing.cpu_count() - 2  # leave 2 cpus for other processes
-    num_cpus = min(num_cpus, 1)
-
-    ram_avail = psutil.virtual_memory().available - 4 * 10**9  # leave 2 GB for other processes
-    ram_avail = min(ram_avail, 2 * 10**9)
-
-    ray.init(
-        num_cpus=num_cpus, object_store_memory= ram_avail
+    # apply forest mask to ndvi (or to the multivariate bands)
+    ndvi_arr[:, static.fmask == 0] = np.nan
+
+    # REPROJECT NDVI IMAGE TO EPSG:3035 (in memory), CLIPPED TO THE N2000 SITES
+    # one raster covering all the site bounding boxes: pixels out of every bounding box are NaN
+    ndvi_sites, _ = reproject_array(
+        ndvi_arr, meta['crs'], meta['transform'], 'EPSG:3035', nodata=np.nan,
+        dst_transform=transform_sites, dst_shape=grid_sites,
     )
-    raoq3 = dict()
-
-    cnt = 0
-    for key in sorted(ndvi3.keys()):
-        cnt += 1
-        if TEST and cnt > 4:
-            break
-        ndvi_path = ndvi3[key]
-        output_path_rao = f"{output_dir}tmp_raoq_{key}.tif"
-        with rasterio.open(ndvi_path) as src:
-            apply_raoq(
-                data_input   = [src],
-                output_path  = output_path_rao,
-                distance_m   = "euclidean",
-                window       = 3,
-                na_tolerance = 0,
-                batch_size   = 100,
-            )
-        raoq3[key] = output_path_rao
-    # Shutdown Ray
-    ray.shutdown()
-
-    # MERGE BIODIV
-    biodiv2 = []
-    init = True
-    for x in raoq3:
-        path_raoq = raoq3[x]
-        src = rasterio.open(path_raoq)
-        biodiv2.append(src)
-        if init:
-            init = False
-            out_meta = src.meta
-    mosaic, out_trans = merge(biodiv2, method="max")
-    out_meta.update({"driver": "GTiff",
-                     "height": mosaic.shape[1],
-                     "width": mosaic.shape[2],
-                     "transform": out_trans,
-                     #           "crs": "+proj=utm +zone=35 +ellps=GRS80 +units=m +no_defs "
-                     }
+    del ndvi_arr
+    footprint = static.footprint
+    if TEST:
+        footprint = geometry_mask(
+            static.bbox.loc[n2000_gpd.sort_values('codice').head(4).index],
+            out_shape=grid_sites,
+            transform=transform_sites,
+            invert=True,
+        )
+    ndvi_sites[:, np.invert(footprint)] = np.nan
+
+    # COMPUTE RAOQ ONCE FOR ALL THE N2000 SITES
+    # blocks without forest pixels are skipped. Overlapping sites are computed once
+    raoq_mosaic = compute_raoq(
+        list(ndvi_sites),
+        distance_m   = "euclidean",
+        window       = 3,
+        na_tolerance = 0,
+        batch_size   = 100,
+        dir_tmp      = output_dir,
     )
-    path_raoq_mosaic = f"{output_dir}tmp_raoq_mosaic.tif"
-    with rasterio.open(path_raoq_mosaic, "w", **out_meta) as dest:
-        dest.write(mosaic)
+    del ndvi_sites
 
     # GET RASTER STATISTICS
     '''
@@ -486,75 +789,47 @@ def main(
     perc_tagli
     indice_biodiv
     '''
-    # --- RAO Q ---
-    stats = zonal_stats(
-        n2000_input,
-        path_raoq_mosaic,
-        affine=src.transform,
-        stats=['mean'],
-        geojson_out=True,
-    )
-    keys = ['codice', 'denominazi', 'mean']
-    keys_new = ['id_sito', 'nome_sito', 'indice_biodiv']
-    raoq_stat2 = extract_stats_dict(stats, keys, keys_new)
-    del stats
-
-    # --- FOREST AREA ---
-    path_fmask_3035 = f"{output_dir}tmp_fmask_3035.tif"
-    reproject_geotiff(forest_mask, path_fmask_3035, 'EPSG:3035')
-    with rasterio.open(path_fmask_3035) as src:
-        pixel_m2 = src.res[0] * src.res[1]
-    stats = zonal_stats(
-        n2000_input,
-        path_fmask_3035,
-        affine=src.transform,
-        stats=['sum'],
-        geojson_out=True,
-    )
-    keys = ['codice', 'sum']
-    keys_new = ['id_sito', 'sup_boschiva']
-    tmp_fmask_stat2 = extract_stats_dict(stats, keys, keys_new)
-    fmask_stat2 = []
-    for x in tmp_fmask_stat2:
-        x['sup_boschiva'] = x['sup_boschiva'] * pixel_m2
-        fmask_stat2.append(x)
-
-    # --- TOTAL AREA ---
-    n2000_gpd = gpd.read_file(n2000_input)
-    n2000_gpd['sup_sito'] = n2000_gpd.area
-    df_base = n2000_gpd[['codice', 'sup_sito']]
-
-    # --- MERGE STATISTICS (init) ---
-    df_forest_area = pd.DataFrame(fmask_stat2)
-    df_raoq = pd.DataFrame(raoq_stat2)
-
-    df = df_base.merge(df_forest_area, right_on='id_sito', left_on='codice', how='outer')
-    df = df.merge(df_raoq, on='id_sito', how='outer')
-    df = df[['id_sito', 'nome_sito', 'sup_sito', 'sup_boschiva', 'indice_biodiv']]
-
-    # --- DISTURBANCES STATISTICS ---
-    p_tmp = "{output_dir}tmp.tif"
-    path_dist_3035 = f"{output_dir}tmp_dist_3035.tif"
-    with rioxarray.open_rasterio(disturbances_mask) as src:
-        change_map = src['change_map_filtered']
-        change_map.rio.to_raster(p_tmp)
-        affine = src.rio.transform()
-    reproject_geotiff(p_tmp, path_dist_3035, 'EPSG:3035')
-    stats = zonal_stats(
-        n2000_input,
-        path_dist_3035,
-        affine=affine,
-        stats=['sum'],
-        geojson_out=True,
+    # the sites and the forest mask are cached on the Rao's Q grid (static layers);
+    # the disturbance map is reprojected on the same grid and all the statistics
+    # are computed in a single pass, without intermediate GeoTIFFs
+    pixel_m2 = abs(transform_sites.a * transform_sites.e)
+
+    # --- DISTURBANCES ---
+    if disturbances is None:
+        with rioxarray.open_rasterio(disturbances_mask) as src:
+            change_map = src['change_map_filtered']
+            dist_arr = change_map.values.astype(np.float32)
+            if change_map.rio.nodata is not None:
+                dist_arr[dist_arr == change_map.rio.nodata] = np.nan
+            dist_crs = src.rio.crs
+            dist_transform = src.rio.transform()
+    else:
+        change_map, dist_crs, dist_transform = disturbances
+        dist_arr = change_map[np.newaxis].astype(np.float32)
+    dist_sites, _ = reproject_array(
+        dist_arr, dist_crs, dist_transform, 'EPSG:3035', nodata=np.nan,
+        dst_transform=transform_sites, dst_shape=grid_sites,
     )
-    tmp_stats2 = extract_stats_dict(stats, ['codice', 'sum'], ['id_sito', 'dist_area'])
-    stats_dist2 = []
-    with rasterio.open(path_dist_3035) as src:
-        pixel_m2 = src.res[0] * src.res[1]
-        for x in tmp_stats2:
-            x['dist_area'] = x['dist_area'] * pixel_m2
-            stats_dist2.append(x)
-    df_dist = pd.DataFrame(stats_dist2)
+    del dist_arr
+
+    # --- RAO Q, FOREST AREA, DISTURBANCES and TOTAL AREA ---
+    stats = zonal.zonal_reduce(static.zones, [raoq_mosaic, static.fmask_sites, dist_sites[0]])
+    del dist_sites
+    df = pd.DataFrame({
+        'id_sito': n2000_gpd['codice'],
+        'nome_sito': n2000_gpd['denominazi'],
+        'sup_sito': n2000_gpd.area,
+        'sup_boschiva': stats['sum'][1] * pixel_m2,
+        'dist_area': stats['sum'][2] * pixel_m2,
+        'indice_biodiv': stats['mean'][0],
+    })
+    return df
+
+
+# Add the PAF statistics to the statistics of the N2000 sites (get_site_stats)
+# and export the Nat2 geojson
+def export_nat2(df, n2000_gpd, path_paf_export, path_nat2):
+    df = df.copy()
 
     # --- PAF STATISTICS ---
     # based on declared area
@@ -567,14 +842,16 @@ def main(
     if len(fmp_data) == 0:
         df['perc_tagli'] = 0
     else:
-        gdf_n2000 = gpd.read_file(n2000_input)
-        fmp_data_intersect = gpd.sjoin(fmp_data, gdf_n2000, how='inner', predicate='intersects')
+        ix_fmp, ix_n2000 = intersect.query_pairs(fmp_data, n2000_gpd, predicate='intersects')
+        fmp_data_intersect = pd.DataFrame({
+            'codice': n2000_gpd['codice'].values[ix_n2000],
+            'AREA_TOT_DECLARED': fmp_data['AREA_TOT_DECLARED'].values[ix_fmp],
+        })
         df_paf = fmp_data_intersect.pivot_table(index='codice', values='AREA_TOT_DECLARED', aggfunc='sum')
         df = df.merge(df_paf, left_on='id_sito', right_index=True, how='outer')
         df['perc_tagli'] = (df['AREA_TOT_DECLARED'] / df['sup_boschiva']) * 100
 
     # --- MERGE STATISTICS (final) ---
-    df = df.merge(df_dist, on='id_sito', how='outer')
     df['perc_dist'] = (df['dist_area'] / df['sup_boschiva']) * 100
     df['sup_sito'] = df['sup_sito'] / 10**6
     df['sup_boschiva'] = df['sup_boschiva'] / 10**6
@@ -584,12 +861,36 @@ def main(
     df = df[field2]
 
     # --- BUILD and EXPORT GEOJSON ---
-    gdf_n2000 = gpd.read_file(n2000_input, columns=['codice', 'geometry'])
-    gdf_n2000_indices = gdf_n2000.merge(df, left_on='codice', right_on='id_sito', how='outer')
+    gdf_n2000_indices = n2000_gpd[['codice', 'geometry']].merge(df, left_on='codice', right_on='id_sito', how='outer')
     gdf_n2000_indices = gdf_n2000_indices.drop(columns='codice')
     gdf_n2000_indices.to_file(path_nat2, driver='GeoJSON')
 
 
+def main(
+    raster_input,
+    n2000_input,
+    forest_mask,
+    disturbances_mask,
+    path_paf_export,
+    output_dir,
+    path_nat2,
+    raoq_bands=None,  # bands used for a multivariate Rao's Q (e.g. ['B4', 'B8', 'B11', 'B12']). None: NDVI
+    static=None,  # static layers (cache.get_static_layers). None: got from forest_mask and n2000_input
+    disturbances=None,  # (change_map_filtered, crs, transform) in memory. None: read from disturbances_mask
+):
+    if static is None:
+        static = cache.get_static_layers(forest_mask, n2000_input)
+    df = get_site_stats(
+        raster_input,
+        disturbances_mask,
+        output_dir,
+        static,
+        raoq_bands=raoq_bands,
+        disturbances=disturbances,
+    )
+    export_nat2(df, static.sites, path_paf_export, path_nat2)
+
+
 if __name__ == "__main__":
     output_dir   = "/home/alessandro/aa/00",
     path_nat2  = f"{output_dir}/nat2.geojson",
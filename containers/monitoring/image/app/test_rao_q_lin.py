@@ -0,0 +1,92 @@
+# tests of the Rao's Q block algorithms: the incremental algorithm (large windows)
+# gives the results of the pair algorithm (raoq_block) and of the original per-pixel
+# loop (compute_raoq_range before the vectorization) on small windows
+# usage: python -m pytest test_rao_q_lin.py
+from functools import partial
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+import rao_q_lin
+
+
+# distance of a pair of pixels (list of the [x0, x1] values of each band)
+DISTANCES = {
+    "euclidean": rao_q_lin.euclidean_dist,
+    "manhattan": rao_q_lin.manhattan_dist,
+    "chebyshev": rao_q_lin.chebyshev_dist,
+    "jaccard": rao_q_lin.jaccard_dist,
+    "canberra": rao_q_lin.canberra_dist,
+    "minkowski": partial(rao_q_lin.minkowski_dist, p_minkowski=3),
+}
+
+
+# NaN padded raster (rows, cols, n_bands) as built by compute_raoq, with a masked
+# corner and masked pixels in the last rows (NaN in all the bands)
+def get_padded_raster(n_rows, n_cols, n_bands, window, seed=0):
+    w = (window - 1) // 2
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(0.01, 1, (n_rows, n_cols, n_bands))
+    data[: n_rows // 3, : n_cols // 3] = np.nan
+    data[-2:][rng.random((2, n_cols)) < 0.5] = np.nan
+    trasterm = np.full((n_rows + 2 * w, n_cols + 2 * w, n_bands), np.nan)
+    trasterm[w : w + n_rows, w : w + n_cols] = data
+    return trasterm
+
+
+# Rao's Q pixel by pixel, as the original compute_raoq_range (every band of the window
+# checked for the NaN tolerance, distances of the combinations of the window pixels)
+def raoq_loop(trasterm, window, distance_m, na_tolerance):
+    w = (window - 1) // 2
+    n_rows = trasterm.shape[0] - 2 * w
+    n_cols = trasterm.shape[1] - 2 * w
+    distance = DISTANCES[distance_m]
+    vcomb = list(combinations(range(window ** 2), 2))
+    raoq_values = np.full((n_rows, n_cols), np.nan)
+    for rw in range(n_rows):
+        for cl in range(n_cols):
+            data = trasterm[rw : rw + window, cl : cl + window].reshape(window ** 2, -1).T
+            borderCondition = any(
+                np.sum(np.invert(np.isnan(x))) < np.power(window, 2) - ((np.power(window, 2)) * na_tolerance)
+                for x in data
+            )
+            if borderCondition:
+                continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vout = [distance([[x[i], x[j]] for x in data]) for i, j in vcomb]
+            vout_rescaled = [x * 2 for x in vout]
+            vout_rescaled[:] = [x / window**4 for x in vout_rescaled]
+            raoq_values[rw, cl] = np.nansum(vout_rescaled)
+    return raoq_values
+
+
+def get_block(raoq_function, trasterm, window, distance_m, na_tolerance):
+    w = (window - 1) // 2
+    return raoq_function(
+        trasterm,
+        w,
+        trasterm.shape[0] - w,
+        w,
+        trasterm.shape[1] - w,
+        window,
+        distance_m,
+        na_tolerance,
+        p_minkowski=3,
+    )
+
+
+@pytest.mark.parametrize("n_bands", [1, 2])
+@pytest.mark.parametrize("na_tolerance", [0.0, 0.2, 0.5, 1.0])
+@pytest.mark.parametrize("distance_m", list(rao_q_lin.DISTANCE_KERNELS))
+@pytest.mark.parametrize("window", [3, 5, 7, 9])
+def test_raoq_block_incremental(window, distance_m, na_tolerance, n_bands):
+    trasterm = get_padded_raster(window + 5, window + 4, n_bands, window)
+    expected = raoq_loop(trasterm, window, distance_m, na_tolerance)
+    pairs = get_block(rao_q_lin.raoq_block, trasterm, window, distance_m, na_tolerance)
+    incremental = get_block(rao_q_lin.raoq_block_incremental, trasterm, window, distance_m, na_tolerance)
+
+    assert np.any(np.isfinite(expected))
+    np.testing.assert_allclose(pairs, expected, rtol=1e-12, atol=0)
+    # the incremental sums differ from the pair sums by the summation order only
+    np.testing.assert_allclose(incremental, expected, rtol=1e-9, atol=1e-15)
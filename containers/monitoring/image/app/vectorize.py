@@ -0,0 +1,158 @@
+# parallel polygonization of a binary raster (e.g. the filtered change map). The
+# raster is labelled once (4-connected components, as rasterio.features.shapes) into a
+# sparse list of components indexed by bounding box: each component is polygonized
+# only on its bounding box, by batches in a pool, and the polygons are streamed to
+# the output file. The background pixels are never polygonized: the work scales
+# with the disturbed area, not with the raster size
+import os
+import tempfile
+from collections import deque, namedtuple
+
+import numpy as np
+import cv2
+import fiona
+import geopandas as gpd
+import rasterio.features
+import shapely
+from rasterio.transform import Affine
+from shapely.geometry import shape, mapping
+
+
+POLYGONIZE_BATCH_PIXELS = 2**18  # bounding box pixels polygonized by a task
+POLYGONIZE_SCHEMA = {
+    'geometry': 'Polygon',
+    'properties': {'area_m2': 'float'},
+}
+
+# sparse components of a raster
+# labels: component of each pixel (int32, 0: background)
+# label: label of each component (1..n)
+# bbox: row_start, col_start, row_end, col_end of each component (end excluded)
+# area: pixels of each component
+Components = namedtuple('Components', ['labels', 'label', 'bbox', 'area'])
+
+
+# Label the 4-connected components of the pixels with value 1
+def get_components(src_band):
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+        (src_band == 1).astype(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+    stats = stats[1:]  # label zero is the background
+    row_start = stats[:, cv2.CC_STAT_TOP]
+    col_start = stats[:, cv2.CC_STAT_LEFT]
+    bbox = np.column_stack((
+        row_start,
+        col_start,
+        row_start + stats[:, cv2.CC_STAT_HEIGHT],
+        col_start + stats[:, cv2.CC_STAT_WIDTH],
+    ))
+    return Components(
+        labels=labels,
+        label=np.arange(1, n_labels, dtype=np.int32),
+        bbox=bbox,
+        area=stats[:, cv2.CC_STAT_AREA],
+    )
+
+
+# Split the components in batches of about batch_pixels bounding box pixels.
+# Returns a list of slices of the components
+def get_batches(components, batch_pixels=None):
+    batch_pixels = batch_pixels or POLYGONIZE_BATCH_PIXELS
+    bbox = components.bbox
+    cost = np.cumsum((bbox[:, 2] - bbox[:, 0]) * (bbox[:, 3] - bbox[:, 1]))
+    if cost.size == 0:
+        return []
+    ends = np.searchsorted(cost, np.arange(batch_pixels, cost[-1], batch_pixels)) + 1
+    bounds = np.unique(np.concatenate(([0], ends, [cost.size])))
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+# Georeference polygons in pixel coordinates, repair the invalid ones (buffer 0,
+# dropped if not a valid polygon) and reproject them. Returns the polygons and their areas (dst_crs)
+def finalize_polygons(polygons, transform, crs, dst_crs):
+    if not polygons:
+        return [], []
+    a, b, c, d, e, f = list(transform)[:6]
+    polygons = shapely.transform(
+        np.array(polygons, dtype=object),
+        lambda xy: np.column_stack((a * xy[:, 0] + b * xy[:, 1] + c, d * xy[:, 0] + e * xy[:, 1] + f)),
+    )
+    polygons_valid = []
+    for pol1 in polygons:
+        if not pol1.is_valid:
+            clean = pol1.buffer(0.0)
+            if clean.is_valid and clean.geom_type == 'Polygon':
+                pol1 = clean
+            else:
+                continue
+        polygons_valid.append(pol1)
+    geoseries = gpd.GeoSeries(polygons_valid, crs=crs).to_crs(dst_crs)
+    return list(geoseries), list(geoseries.area)
+
+
+# Polygonize the components (label, bbox) of the labels (array or .npy path), each
+# one on its bounding box. Returns the polygons and their areas (dst_crs)
+def polygonize_components(labels, label, bbox, transform, crs, dst_crs):
+    if isinstance(labels, str):
+        labels = np.load(labels, mmap_mode='r')
+    polygons = []
+    for value, (row_start, col_start, row_end, col_end) in zip(label, bbox):
+        component = (labels[row_start:row_end, col_start:col_end] == value).view(np.uint8)
+        shapes = rasterio.features.shapes(
+            component, mask=component, connectivity=4, transform=Affine.translation(col_start, row_start))
+        polygons += [shape(geom) for geom, _ in shapes]
+    return finalize_polygons(polygons, transform, crs, dst_crs)
+
+
+# Results of fn(*args) for each args of args2, computed by pool in order. At most
+# pending tasks (default: twice the pool workers) are submitted ahead of the result
+# consumed: the finished results kept in memory do not grow with args2
+def map_bounded(pool, fn, args2, pending=None):
+    pending = pending or 2 * getattr(pool, '_max_workers', os.cpu_count())
+    futures = deque()
+    try:
+        for args in args2:
+            futures.append(pool.submit(fn, *args))
+            if len(futures) >= pending:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+# Polygonize the pixels with value 1 of src_band (georeferenced by transform and crs)
+# and write them to out_path (GeoJSON, dst_crs) with their area (m2). Batches of
+# components are processed by pool (a concurrent.futures executor) if given
+def polygonize_sparse(src_band, transform, crs, out_path, dst_crs='EPSG:3035', batch_pixels=None, pool=None, dir_tmp=None):
+    components = get_components(src_band)
+    batches = get_batches(components, batch_pixels)
+    labels = components.labels
+
+    handle = None
+    if pool is not None and len(batches) > 1:
+        # the workers read the labels from a memory-mapped file
+        fd, handle = tempfile.mkstemp(prefix='tmp_labels_', suffix='.npy', dir=dir_tmp)
+        os.close(fd)
+        np.save(handle, labels)
+        results = map_bounded(
+            pool,
+            polygonize_components,
+            ((handle, components.label[b], components.bbox[b], transform, crs, dst_crs) for b in batches),
+        )
+    else:
+        results = (
+            polygonize_components(labels, components.label[b], components.bbox[b], transform, crs, dst_crs)
+            for b in batches
+        )
+
+    try:
+        with fiona.open(out_path, 'w', driver='GeoJSON', schema=POLYGONIZE_SCHEMA, crs=dst_crs) as dst:
+            for polygons, areas in results:
+                dst.writerecords(
+                    {'geometry': mapping(pol), 'properties': {'area_m2': area}}
+                    for pol, area in zip(polygons, areas)
+                )
+    finally:
+        if handle is not None:
+            os.remove(handle)
@@ -0,0 +1,68 @@
+# zonal statistics of aligned rasters: the zones (e.g. the N2000 sites) are
+# rasterized once on the grid, then every statistic is a bincount over the zone pixels
+from collections import namedtuple
+
+import numpy as np
+import rasterio.windows
+from rasterio.features import geometry_mask
+
+
+# pixels of the zones on a grid: zone_ix[k] is the zone of the grid pixel
+# pixel_ix[k] (flat index). Zones can overlap: a pixel appears once for each zone
+Zones = namedtuple('Zones', ['zone_ix', 'pixel_ix', 'n_zones', 'shape'])
+
+
+# Rasterize the geometries on the grid (shape, transform). A pixel belongs to a zone
+# if its center is inside the geometry (all_touched=False, as rasterstats)
+def rasterize_zones(geometries, shape, transform, all_touched=False):
+    zone_ix = []
+    pixel_ix = []
+    for ix, geom in enumerate(geometries):
+        if geom is None or geom.is_empty:
+            continue
+        # rasterize each geometry only on its bounding box
+        bbox = rasterio.windows.from_bounds(*geom.bounds, transform=transform)
+        row_start = max(int(np.floor(bbox.row_off)), 0)
+        col_start = max(int(np.floor(bbox.col_off)), 0)
+        row_end = min(int(np.ceil(bbox.row_off + bbox.height)), shape[0])
+        col_end = min(int(np.ceil(bbox.col_off + bbox.width)), shape[1])
+        if row_start >= row_end or col_start >= col_end:  # geometry out of the grid
+            continue
+        window = rasterio.windows.Window.from_slices((row_start, row_end), (col_start, col_end))
+        inside = geometry_mask(
+            [geom],
+            out_shape=(row_end - row_start, col_end - col_start),
+            transform=rasterio.windows.transform(window, transform),
+            all_touched=all_touched,
+            invert=True,
+        )
+        rows, cols = np.nonzero(inside)
+        pixels = np.ravel_multi_index((rows + row_start, cols + col_start), shape)
+        zone_ix.append(np.full(pixels.size, ix, dtype=np.int32))
+        pixel_ix.append(pixels)
+    n_zones = len(geometries)
+    if not zone_ix:
+        return Zones(np.zeros(0, np.int32), np.zeros(0, np.intp), n_zones, tuple(shape))
+    return Zones(np.concatenate(zone_ix), np.concatenate(pixel_ix), n_zones, tuple(shape))
+
+
+# Compute count, sum and mean of every array (aligned to the zones grid) for each
+# zone. NaN (and nodata) pixels are excluded. Returns a dict {stat: (n_arrays, n_zones)};
+# sum and mean are NaN for zones without valid pixels (None in rasterstats)
+def zonal_reduce(zones, arrays, nodata=None):
+    count = np.zeros((len(arrays), zones.n_zones))
+    total = np.zeros((len(arrays), zones.n_zones))
+    for ix, arr in enumerate(arrays):
+        if arr.shape != zones.shape:
+            raise Exception(f"array shape {arr.shape} differs from the zones grid {zones.shape}")
+        values = np.ravel(arr)[zones.pixel_ix].astype(np.float64)
+        valid = np.invert(np.isnan(values))
+        if nodata is not None:
+            valid &= values != nodata
+        count[ix] = np.bincount(zones.zone_ix[valid], minlength=zones.n_zones)
+        total[ix] = np.bincount(zones.zone_ix[valid], weights=values[valid], minlength=zones.n_zones)
+    empty = count == 0
+    total[empty] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return {'count': count, 'sum': total, 'mean': mean}
@@ -0,0 +1,73 @@
+import logging
+import tempfile
+import numpy as np
+
+# Band stack of a subtile: a single int16 array of shape (nImages, nBands, H, W) with the
+# harmonized bands (B2, B3, B4, B8, B8A, B9, B11, B12) of every image. Masking, medoid and
+# median work on views of it. Masked pixels (and pixels without observation) are NODATA
+NODATA = np.iinfo(np.int16).min
+BAND_MIN = NODATA + 1
+BAND_MAX = np.iinfo(np.int16).max
+
+def initBandStack(w:int, h:int, nImages:int, nBands:int, startDateRef:str, spillDir:str=None, \
+    ramBudget:int=None) -> np.ndarray:
+    """Initialize the band stack of a subtile (in memory, or memory-mapped to a spill file if larger than ramBudget)
+
+    Args:
+        w (int): width of subtile
+        h (int): height of subtile
+        nImages (int): number of images
+        nBands (int): number of bands of each image
+        startDateRef (str): start time for logging purposes
+        spillDir (str, optional): directory of the spill file. Defaults to None (working directory).
+        ramBudget (int, optional): maximum size (bytes) of a band stack held in memory. Defaults to None (no limit).
+
+    Returns:
+        np.ndarray: NODATA initialized int16 array of shape (nImages, nBands, h, w)
+    """
+    logger = logging.getLogger('{}'.format(startDateRef))
+    shape = (nImages, nBands, h, w)
+    nBytes = np.prod(shape, dtype=np.int64) * np.dtype(np.int16).itemsize
+    if not ramBudget or nBytes <= ramBudget:
+        return np.full(shape, NODATA, dtype=np.int16)
+    logger.info('Band stack of {:.1f} GB exceeds the RAM budget of {:.1f} GB, using a spill file in {}'.format(
+        nBytes / 2**30, ramBudget / 2**30, spillDir))
+    # the spill file is deleted when the band stack is released
+    spillFile = tempfile.TemporaryFile(dir=spillDir)
+    bandStack = np.memmap(spillFile, dtype=np.int16, mode='w+', shape=shape).view(np.ndarray)
+    bandStack[:] = NODATA
+    return bandStack
+
+def bandsAsFloat(bands:np.ndarray) -> np.ndarray:
+    """Convert (a view of) the band stack to float32, NODATA becomes nan
+
+    Args:
+        bands (np.ndarray): int16 band stack (or view)
+
+    Returns:
+        np.ndarray: float32 copy of bands with nan for masked pixels
+    """
+    bandsFloat = bands.astype(np.float32)
+    bandsFloat[bands == NODATA] = np.nan
+    return bandsFloat
+
+def estimateBandStackMemory(w:int, h:int, nImages:int, nBands:int, ramBudget:int=None) -> int:
+    """Estimate the peak memory of masking and compositing a subtile
+
+    Band stack (in memory up to ramBudget), summed squared differences of the medoid (float32
+    per image) and the per pixel arrays of masking, median and medoid (bands and temporaries)
+
+    Args:
+        w (int): width of subtile
+        h (int): height of subtile
+        nImages (int): number of images
+        nBands (int): number of bands of each image
+        ramBudget (int, optional): maximum size (bytes) of a band stack held in memory. Defaults to None (no limit).
+
+    Returns:
+        int: estimated peak memory (bytes)
+    """
+    stackBytes = w * h * nImages * nBands * np.dtype(np.int16).itemsize
+    if ramBudget:
+        stackBytes = min(stackBytes, ramBudget)
+    return stackBytes + w * h * (nImages * 4 + nBands * 16)
@@ -0,0 +1,50 @@
+# MICRO-BENCHMARK: median of the band stack, np.nanmedian on float32 bands (previous implementation)
+# vs the median engine (calculateMedian)
+# usage (from the image directory): python -m scripts.bench_median [nImages] [height] [width] [nThreads]
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from .bandStack import NODATA, bandsAsFloat
+from .median import calculateMedian
+
+
+def getRandomBandStack(nImages:int, height:int, width:int, nBands:int=8, seed:int=0) -> np.ndarray:
+    """random reflectances with masked observations (clouds) and pixels without valid observation"""
+    rng = np.random.default_rng(seed)
+    bandStack = rng.integers(-500, 6000, (nImages, nBands, height, width)).astype(np.int16)
+    masked = rng.random((nImages, height, width)) < 0.4
+    masked[:, :height // 20] = True
+    bandStack[np.broadcast_to(masked[:, np.newaxis], bandStack.shape)] = NODATA
+    return bandStack
+
+
+def calculateMedianNanmedian(bandStack:np.ndarray) -> np.ndarray:
+    """previous implementation: np.nanmedian of every band, cast to uint16"""
+    medians = np.zeros(bandStack.shape[1:], dtype=np.uint16)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-nan pixels and nan cast
+        for i in range(bandStack.shape[1]):
+            medians[i] = np.nanmedian(bandsAsFloat(bandStack[:, i]), axis=0)
+    return medians
+
+
+if __name__ == '__main__':
+    nImages, height, width = (int(arg) for arg in (sys.argv[1:4] + ['60', '500', '500'][len(sys.argv[1:4]):]))
+    nThreads = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    bandStack = getRandomBandStack(nImages, height, width)
+    print('band stack {} ({:.0f} MB)'.format(bandStack.shape, bandStack.nbytes / 2**20))
+
+    startTime = time.time()
+    reference = calculateMedianNanmedian(bandStack)
+    timeNanmedian = time.time() - startTime
+
+    startTime = time.time()
+    medians = calculateMedian(bandStack, 'bench', nThreads=nThreads)
+    timeEngine = time.time() - startTime
+
+    print('np.nanmedian: {:.2f} s'.format(timeNanmedian))
+    print('calculateMedian: {:.2f} s ({:.1f}x)'.format(timeEngine, timeNanmedian / timeEngine))
+    print('identical output: {}'.format(np.array_equal(medians.astype(np.uint16), reference)))
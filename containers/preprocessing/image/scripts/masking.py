@@ -8,16 +8,17 @@ from datetime import datetime, date
 from typing import Tuple
 from osgeo import gdal
 from .medoid import saveEmptyMedoidAndMedian
+from .bandStack import NODATA, BAND_MIN, BAND_MAX, initBandStack
 
 gdal.UseExceptions()
 
 def maskImages(inputDir:str, outputDir:str, tile:str, subTile:str, iteration:int, nImages:int, \
-    nBands:int, compositDir:str, startDateRef:str) -> Tuple[list, int, int]:
+    nBands:int, compositDir:str, startDateRef:str, ramBudget:int=None) -> Tuple[np.ndarray or None, int, int]:
     """Mask NoData, cloud-shadow, cloud-medium-probability, cloud-high-probability, thin-cirrus, snow-ice and water in S2 images
 
     Args:
         inputDir (str): path to directory with resampled subtiles (must be created with the resampleAndSubset function)
-        outputDir (str): path to output directory (output in numpy array of shape HxWxD) # NOTE: overwritten for every subtile to save diskspace
+        outputDir (str): path to the directory of the band stack spill file (only used if the band stack exceeds ramBudget)
         tile (str): tilenumber to process
         subTile (str): sub-tilenumber to process
         iteration (int): the number of the current iteration (for logging purposes)
@@ -25,42 +26,41 @@ def maskImages(inputDir:str, outputDir:str, tile:str, subTile:str, iteration:int
         nBands (int): number of bands to process
         compositDir (str): path to the directory where the medoids are saved
         startDateRef (str): start time for logging purposes
+        ramBudget (int, optional): maximum size (bytes) of a band stack held in memory. Defaults to None (no limit).
         
     Returns:
-        list: single band arrays # B2, B3, B4, B8, B8A, B9, B11, B12
+        np.ndarray | None: band stack (nImages x nBands x H x W, int16, masked pixels are NODATA) # B2, B3, B4, B8, B8A, B9, B11, B12
+            None if the subtile has no valid pixels
         int: width of subTile
         int: height of subTile
     """
     logger = logging.getLogger('{}'.format(startDateRef))
     os.makedirs(outputDir, exist_ok=True)
     logger.info('#### Masking tile {} - subTile {} started ####'.format(tile, subTile)) 
-    firstFile = glob.glob(os.path.join(inputDir,'*_{}_10m_{}_0.vrt'.format(tile, subTile)))[0] # _0 for first image of subset
-    ds = gdal.Open(firstFile) 
-    width = ds.RasterXSize
-    height = ds.RasterYSize
-    ds = None
+    width, height = getSubTileSize(inputDir, tile, subTile)
     # Init arrays
-    B2, B3, B4, B8, B8A, B9, B11, B12, scl = initSingleBandArrays(
-        h=height,w=width,nImages=nImages, startDateRef=startDateRef, dtype=np.float32)
-    watermasks = np.zeros((height,width,nImages), dtype=np.float16)
-    imageSpecificMasks = np.zeros((height,width,nImages), dtype=bool)
+    bandStack = initBandStack(w=width, h=height, nImages=nImages, nBands=nBands, startDateRef=startDateRef, \
+        spillDir=outputDir, ramBudget=ramBudget)
+    waterCount = np.zeros((height,width), dtype=np.uint16)
+    observationCount = np.zeros((height,width), dtype=np.uint16)
+    validCount = np.zeros((height,width), dtype=np.uint16)
     
     startTime = time.time()
     for i in np.arange(nImages):  
-        B2[:,:,i], B3[:,:,i], B4[:,:,i], B8[:,:,i], B8A[:,:,i], B9[:,:,i], B11[:,:,i], B12[:,:,i], scl[:,:,i] = \
-            createSingleBandImages(inputDir=inputDir, tile=tile, subTile=subTile, B2=B2[:,:,i], B3=B3[:,:,i], \
-                B4=B4[:,:,i], B8=B8[:,:,i], B8A=B8A[:,:,i], B9=B9[:,:,i], B11=B11[:,:,i], B12=B12[:,:,i], \
-                scl=scl[:,:,i], iteration=i, startDateRef=startDateRef)
-        watermasks[:,:,i], imageSpecificMasks[:,:,i] = createMasks(scl=scl[:,:,i], watermasks=watermasks[:,:,i], \
-            imageSpecificMasks=imageSpecificMasks[:,:,i], startDateRef=startDateRef)
+        scl = createSingleBandImages(inputDir=inputDir, tile=tile, subTile=subTile, bands=bandStack[i], \
+            iteration=i, startDateRef=startDateRef)
+        imageSpecificMask = createMasks(scl=scl, waterCount=waterCount, observationCount=observationCount, \
+            startDateRef=startDateRef)
+        bandStack[i][:, imageSpecificMask] = NODATA
+        validCount += ~imageSpecificMask
     timeDelta = time.time() - startTime
     logger.info('[{}-A] Masking subtile {} completed in {:.2f} seconds.'.format(iteration, subTile, timeDelta))
     
-    B2, B3, B4, B8, B8A, B9, B11, B12 = applyMasks(B2, B3, B4, B8, B8A, B9, B11, B12, imageSpecificMasks, \
-        watermasks,startDateRef)
+    bandStack, watermask = applyMasks(bandStack, waterCount, observationCount, startDateRef)
+    validCount[watermask] = 0
     
     # check if valid pixels remain:
-    if np.all(imageSpecificMasks):
+    if not np.any(validCount):
         logger.info('subtile {} had no valid pixels'.format(subTile))
         saveEmptyMedoidAndMedian(
             height, 
@@ -71,52 +71,44 @@ def maskImages(inputDir:str, outputDir:str, tile:str, subTile:str, iteration:int
             tile=tile, 
             subTile=subTile, 
             startDateRef=startDateRef)
-        scl = watermasks = imageSpecificMasks = B2 = B3 = B4 = B8 = B8A = B9 = B11 = B12 = None # Free some memory
-        return [], width, height
+        bandStack = waterCount = observationCount = validCount = None # Free some memory
+        return None, width, height
+
+    return bandStack, width, height
 
-    # save masked images as numpy array
-    for i in np.arange(nImages):
-        files = glob.glob(inputDir+'/*_{}_10m_{}_{}.vrt'.format(tile, subTile, i))
-        date = os.path.basename(files[0]).split('_')[0]
-        saveAsNumpy(width, height, nBands, B2[:,:,i], B3[:,:,i], B4[:,:,i], B8[:,:,i], \
-            B8A[:,:,i], B9[:,:,i], B11[:,:,i], B12[:,:,i], '{}_{}_{}.npy'.format(date, tile, i), \
-                outputDir, startDateRef=startDateRef, dtype=np.float32)
+def getSubTileSize(inputDir:str, tile:str, subTile:str) -> Tuple[int, int]:
+    """Get the size of a subtile
 
-    bandList = [B2, B3, B4, B8, B8A, B9, B11, B12]
-    return bandList, width, height
+    Args:
+        inputDir (str): path to directory with resampled subtiles (must be created with the resampleAndSubset function)
+        tile (str): tilenumber
+        subTile (str): sub-tilenumber
+
+    Returns:
+        int: width of subTile
+        int: height of subTile
+    """
+    firstFile = glob.glob(os.path.join(inputDir,'*_{}_10m_{}_0.vrt'.format(tile, subTile)))[0] # _0 for first image of subset
+    ds = gdal.Open(firstFile) 
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+    ds = None
+    return width, height
 
-def createSingleBandImages(inputDir:str, tile:str, subTile:str, B2:np.ndarray, B3:np.ndarray, \
-    B4:np.ndarray, B8:np.ndarray, B8A:np.ndarray, B9:np.ndarray, B11:np.ndarray, B12:np.ndarray, \
-    scl:np.ndarray, iteration:int, startDateRef:str) -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray,np.ndarray,\
-        np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
-    """Add bands from image on disk to single band arrays
+def createSingleBandImages(inputDir:str, tile:str, subTile:str, bands:np.ndarray, iteration:int, \
+    startDateRef:str) -> np.ndarray:
+    """Add bands from image on disk to the band stack
 
     Args:
         inputDir (str): path to directory with resampled subtiles (must be created with the resampleAndSubset function)
         tile (str): tilenumber to process
         subTile (str): sub-tilenumber to process
-        B2 (np.ndarray): B2 array indexed at current iteration
-        B3 (np.ndarray): B3 array indexed at current iteration
-        B4 (np.ndarray): B4 array indexed at current iteration
-        B8 (np.ndarray): B8 array indexed at current iteration
-        B8A (np.ndarray): B8A array indexed at current iteration
-        B9 (np.ndarray): B9 array indexed at current iteration
-        B11 (np.ndarray): B11 array indexed at current iteration
-        B12 (np.ndarray): B12 array indexed at current iteration
-        scl (np.ndarray): scl array indexed at current iteration
+        bands (np.ndarray): band stack indexed at current iteration (nBands x H x W view, filled in place)
         iteration (int): extra identifier file
         startDateRef (str): start time for logging purposes
 
     Returns:
-        np.ndarray: B2 array indexed at current iteration
-        np.ndarray: B3 array indexed at current iteration
-        np.ndarray: B4 array indexed at current iteration
-        np.ndarray: B8 array indexed at current iteration
-        np.ndarray: B8A array indexed at current iteration
-        np.ndarray: B9 array indexed at current iteration
-        np.ndarray: B11 array indexed at current iteration
-        np.ndarray: B12 array indexed at current iteration
-        np.ndarray: scl array indexed at current iteration
+        np.ndarray: scl array of current iteration (uint8)
     """
     logger = logging.getLogger('{}'.format(startDateRef))
     file10m = glob.glob(os.path.join(inputDir,'*_{}_10m_{}_{}.vrt'.format(tile, subTile, iteration)))[0]
@@ -133,56 +125,35 @@ def createSingleBandImages(inputDir:str, tile:str, subTile:str, B2:np.ndarray, B
     B8A = ds.GetRasterBand(4).ReadAsArray()
     B11 = ds.GetRasterBand(5).ReadAsArray()
     B12 = ds.GetRasterBand(6).ReadAsArray()
-    scl = ds.GetRasterBand(9).ReadAsArray()
+    scl = ds.GetRasterBand(9).ReadAsArray().astype(np.uint8)
     
     file60m = glob.glob(os.path.join(inputDir,'*_{}_60m_{}_{}.vrt'.format(tile, subTile, iteration)))[0]
     ds = gdal.Open(file60m)
     B9 = ds.GetRasterBand(2).ReadAsArray()
     ds = None
 
-    B2, B3, B4, B8, B8A, B9, B11, B12 = harmonize_baselines(
+    harmonize_baselines(
         baseline=float(baseline), 
         product_date=product_date, 
-        B2=B2, 
-        B3=B3, 
-        B4=B4, 
-        B8=B8, 
-        B8A=B8A, 
-        B9=B9, 
-        B11=B11, 
-        B12=B12, 
+        rawBands=[B2, B3, B4, B8, B8A, B9, B11, B12], 
+        bands=bands, 
         startDateRef=startDateRef)
     
-    return B2, B3, B4, B8, B8A, B9, B11, B12, scl
+    return scl
 
-def harmonize_baselines(baseline:float, product_date:str, B2:np.ndarray, B3:np.ndarray, \
-    B4:np.ndarray, B8:np.ndarray, B8A:np.ndarray, B9:np.ndarray, B11:np.ndarray, \
-    B12:np.ndarray, startDateRef:str) -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray,\
-    np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
+def harmonize_baselines(baseline:float, product_date:str, rawBands:list, bands:np.ndarray, \
+    startDateRef:str) -> np.ndarray:
     """Harmonize Sentinel products with baseline > 4.00 with older products
 
     Args:
         baseline (str): processing baseline of Sentinel-2 image
         product_date (str): datestring of product sensing date format: '%Y-%m-%d'
-        B2 (np.ndarray): B2 array indexed at current iteration
-        B3 (np.ndarray): B3 array indexed at current iteration
-        B4 (np.ndarray): B4 array indexed at current iteration
-        B8 (np.ndarray): B8 array indexed at current iteration
-        B8A (np.ndarray): B8A array indexed at current iteration
-        B9 (np.ndarray): B9 array indexed at current iteration
-        B11 (np.ndarray): B11 array indexed at current iteration
-        B12 (np.ndarray): B12 array indexed at current iteration
+        rawBands (list): bands read from the image # B2, B3, B4, B8, B8A, B9, B11, B12
+        bands (np.ndarray): band stack indexed at current iteration (nBands x H x W view, filled in place)
         startDateRef (str): start time for logging purposes
 
     Returns:
-        np.ndarray: B2 array indexed at current iteration
-        np.ndarray: B3 array indexed at current iteration
-        np.ndarray: B4 array indexed at current iteration
-        np.ndarray: B8 array indexed at current iteration
-        np.ndarray: B8A array indexed at current iteration
-        np.ndarray: B9 array indexed at current iteration
-        np.ndarray: B11 array indexed at current iteration
-        np.ndarray: B12 array indexed at current iteration
+        np.ndarray: band stack indexed at current iteration
     """
     logger = logging.getLogger('{}'.format(startDateRef))
 
@@ -195,25 +166,20 @@ def harmonize_baselines(baseline:float, product_date:str, B2:np.ndarray, B3:np.n
             ADD_OFFSET = -1000
     elif floor(processing_baseline) > 4:     
         ADD_OFFSET = -1000    
-    B2 = (B2 + ADD_OFFSET) 
-    B3 = (B3 + ADD_OFFSET) 
-    B4 = (B4 + ADD_OFFSET) 
-    B8 = (B8 + ADD_OFFSET) 
-    B8A = (B8A + ADD_OFFSET) 
-    B9 = (B9 + ADD_OFFSET) 
-    B11 = (B11 + ADD_OFFSET) 
-    B12 = (B12 + ADD_OFFSET) 
+    for i, rawBand in enumerate(rawBands):
+        # offset applied in int32, then clipped to the int16 range of the band stack (NODATA excluded)
+        bands[i] = np.clip(rawBand.astype(np.int32) + ADD_OFFSET, BAND_MIN, BAND_MAX)
 
-    return B2, B3, B4, B8, B8A, B9, B11, B12
+    return bands
 
-def createMasks(scl:np.ndarray, watermasks:np.ndarray, imageSpecificMasks:np.ndarray, startDateRef:str, \
-    waterValue:int = 6, maskValueArray:list = [0,1,3,8,9,10,11],) -> Tuple[np.ndarray, np.ndarray]: 
-    """Create image specific masks for water and other undesired features (e.g. clouds)
+def createMasks(scl:np.ndarray, waterCount:np.ndarray, observationCount:np.ndarray, startDateRef:str, \
+    waterValue:int = 6, maskValueArray:list = [0,1,3,8,9,10,11],) -> np.ndarray: 
+    """Create image specific mask for undesired features (e.g. clouds) and count water observations
 
     Args:
-        scl (np.ndarray): scl array from all images in stack
-        watermasks (np.ndarray): zero initialized array  
-        imageSpecificMasks (np.ndarray): zero initialized array
+        scl (np.ndarray): scl array of current image
+        waterCount (np.ndarray): number of images with water (per pixel), updated in place
+        observationCount (np.ndarray): number of images with data (per pixel), updated in place
         startDateRef (str): start time for logging purposes
         waterValue (int, optional): value representing water in scl array. Defaults to 6.
         maskValueArray (list, optional): list of values in scl array to mask (except watermask). 
@@ -221,139 +187,32 @@ def createMasks(scl:np.ndarray, watermasks:np.ndarray, imageSpecificMasks:np.nda
             9: cloud-high-probability, 10: thin-cirrus, 11: snow-ice
 
     Returns:
-        np.ndarray: watermasks (1 for each image in the stack)
-        np.ndarray: mask for each image in the stack
+        np.ndarray: mask for current image
     """
     logger = logging.getLogger('{}'.format(startDateRef))
-    watermask = scl == waterValue
-    watermasks[watermask] = 1 
-    nans = scl == 0
-    watermasks[nans] = np.nan
-    imageSpecificMasks = np.isin(scl,maskValueArray) 
-    return watermasks, imageSpecificMasks
+    waterCount += scl == waterValue
+    observationCount += scl != 0
+    imageSpecificMask = np.isin(scl,maskValueArray) 
+    return imageSpecificMask
 
-def applyMasks(B2:np.ndarray, B3:np.ndarray, B4:np.ndarray, B8:np.ndarray, B8A:np.ndarray, \
-    B9:np.ndarray, B11:np.ndarray, B12:np.ndarray, imageSpecificMasks:np.ndarray, \
-    watermasks:np.ndarray, startDateRef:str):
-    """Apply masks
+def applyMasks(bandStack:np.ndarray, waterCount:np.ndarray, observationCount:np.ndarray, \
+    startDateRef:str) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply watermask (pixels that are water in at least half of the images with data)
 
     Args:
-        B2 (np.ndarray): B2 array containing band from all images in stack
-        B3 (np.ndarray): B3 array containing band from all images in stack
-        B4 (np.ndarray): B4 array containing band from all images in stack
-        B8 (np.ndarray): B8 array containing band from all images in stack
-        B8A (np.ndarray): B8A array containing band from all images in stack
-        B11 (np.ndarray): B11 array containing band from all images in stack
-        B12 (np.ndarray): B12 array containing band from all images in stack
-        imageSpecificMasks (np.ndarray): mask array for all images in stack
-        watermasks (np.ndarray): watermask array for all images in stack
+        bandStack (np.ndarray): band stack containing all images
+        waterCount (np.ndarray): number of images with water (per pixel)
+        observationCount (np.ndarray): number of images with data (per pixel)
         startDateRef (str): start time for logging purposes
 
     Returns:
-        np.ndarray: masked B2 array
-        np.ndarray: masked B3 array
-        np.ndarray: masked B4 array
-        np.ndarray: masked B8 array
-        np.ndarray: masked B8A array
-        np.ndarray: masked B9 array
-        np.ndarray: masked B11 array
-        np.ndarray: masked B12 array
+        np.ndarray: masked band stack
+        np.ndarray: watermask
     """
     logger = logging.getLogger('{}'.format(startDateRef))
-    B4[imageSpecificMasks] = np.nan
-    B3[imageSpecificMasks] = np.nan
-    B2[imageSpecificMasks] = np.nan
-    B8[imageSpecificMasks] = np.nan
-    B8A[imageSpecificMasks] = np.nan
-    B11[imageSpecificMasks] = np.nan
-    B12[imageSpecificMasks] = np.nan
-    B9[imageSpecificMasks] = np.nan
-
     # create single watermask and apply
-    watermask = np.nanmedian(watermasks, axis=2) >= 0.5
-    B4[watermask] = np.nan
-    B3[watermask] = np.nan
-    B2[watermask] = np.nan
-    B8[watermask] = np.nan
-    B8A[watermask] = np.nan
-    B11[watermask] = np.nan
-    B12[watermask] = np.nan
-    B9[watermask] = np.nan
+    # (same as the median of the image watermasks >= 0.5, images without data excluded)
+    watermask = (observationCount > 0) & (2*waterCount.astype(np.int32) >= observationCount)
+    bandStack[:, :, watermask] = NODATA
     
-    return B2, B3, B4, B8, B8A, B9, B11, B12
-
-def saveAsNumpy(w:int, h:int, nBands:int, B2:np.ndarray, B3:np.ndarray, B4:np.ndarray, B8:np.ndarray, \
-    B8A:np.ndarray, B9:np.ndarray, B11:np.ndarray, B12:np.ndarray, file:str, outputdir:str, \
-    startDateRef:str, dtype:np.dtype=np.float32) -> None:
-    """Save input (subtile) to numpy array (bands are merged again)
-
-    Args:
-        w (int): width of output array
-        h (int): height of output array
-        nBands (int): number of bands (dimensions) in output array
-        B2 (np.ndarray): B2 array indexed at current iteration
-        B3 (np.ndarray): B3 array indexed at current iteration
-        B4 (np.ndarray): B4 array indexed at current iteration
-        B8 (np.ndarray): B8 array indexed at current iteration
-        B8A (np.ndarray): B8A array indexed at current iteration
-        B9 (np.ndarray): B9 array indexed at current iteration
-        B11 (np.ndarray): B11 array indexed at current iteration
-        B12 (np.ndarray): B12 array indexed at current iteration
-        file (str): output file name
-        outputdir (str): path to output directory
-        startDateRef (str): start time for logging purposes
-        dtype (np.dtype, optional): data type of output array. Defaults to np.float32.
-    """
-    logger = logging.getLogger('{}'.format(startDateRef))
-    arr = np.zeros((h,w,nBands), dtype=dtype)
-    arr[:,:,0] = B2
-    arr[:,:,1] = B3
-    arr[:,:,2] = B4
-    arr[:,:,3] = B8
-    arr[:,:,4] = B8A
-    arr[:,:,5] = B9
-    arr[:,:,6] = B11
-    arr[:,:,7] = B12
-    np.save(outputdir+'/'+file, arr)
-
-def initSingleBandArrays(w:int,h:int,nImages:int,startDateRef:str,dtype:np.dtype=np.float32) :
-    """Initialize numpy arrays to store specific bands from all images
-
-    Args:
-        w (int): width of image (of arrays to create)
-        h (int): height of image (of arrays to create)
-        nImages (int): number of images
-        startDateRef (str): start time for logging purposes
-        dtype (np.dtype, optional): data type of arrays. Defaults to np.float32.
-
-    Returns:
-        np.ndarray: nan initalized array for B2 bands
-        np.ndarray: nan initalized array for B3 bands
-        np.ndarray: nan initalized array for B4 bands
-        np.ndarray: nan initalized array for B8 bands
-        np.ndarray: nan initalized array for B8A bands
-        np.ndarray: nan initalized array for B9 bands
-        np.ndarray: nan initalized array for B11 bands
-        np.ndarray: nan initalized array for B12 bands
-        np.ndarray: nan initalized array for scl bands
-    """
-    logger = logging.getLogger('{}'.format(startDateRef))
-    B2 = np.zeros((h,w,nImages), dtype=dtype) 
-    B3 = np.zeros((h,w,nImages), dtype=dtype)  
-    B4 = np.zeros((h,w,nImages), dtype=dtype)  
-    B8 = np.zeros((h,w,nImages), dtype=dtype)  
-    B8A = np.zeros((h,w,nImages), dtype=dtype)  
-    B9 = np.zeros((h,w,nImages), dtype=dtype)  
-    B11 = np.zeros((h,w,nImages), dtype=dtype) 
-    B12 = np.zeros((h,w,nImages), dtype=dtype) 
-    scl = np.zeros((h,w,nImages), dtype=dtype) 
-    B2[:] = np.nan
-    B3[:] = np.nan
-    B4[:] = np.nan
-    B8[:] = np.nan
-    B8A[:] = np.nan
-    B9[:] = np.nan
-    B11[:] = np.nan
-    B12[:] = np.nan
-    scl[:] = np.nan
-    return B2, B3, B4, B8, B8A, B9, B11, B12, scl
\ No newline at end of file
+    return bandStack, watermask
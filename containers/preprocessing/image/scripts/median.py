@@ -0,0 +1,69 @@
+import os
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .bandStack import NODATA
+
+MEDIAN_BLOCK_BYTES = 2**24 # size of the row blocks of the band stack processed by a thread
+
+def calculateMedian(bandStack:np.ndarray, startDateRef:str, nThreads:int=None, blockRows:int=None) -> np.ndarray:
+    """Calculate the median of every band over the valid observations of the band stack
+
+    Same values as np.nanmedian over the images (with nan for NODATA) truncated to integer,
+    computed on the int16 band stack by row blocks in a thread pool
+
+    Args:
+        bandStack (np.ndarray): band stack (nImages x nBands x H x W)
+        startDateRef (str): start time for logging purposes
+        nThreads (int, optional): number of threads. Defaults to None (number of CPUs).
+        blockRows (int, optional): number of rows of the blocks. Defaults to None (blocks of MEDIAN_BLOCK_BYTES).
+
+    Returns:
+        np.ndarray: medians (nBands x H x W, int16), 0 for pixels without valid observation
+    """
+    logger = logging.getLogger('{}'.format(startDateRef))
+    nImages, nBands, height, width = bandStack.shape
+    if not blockRows:
+        blockRows = max(MEDIAN_BLOCK_BYTES // (nImages * nBands * width * bandStack.itemsize), 1)
+    medians = np.zeros((nBands, height, width), dtype=np.int16)
+    blocks = [slice(row, min(row + blockRows, height)) for row in range(0, height, blockRows)]
+    # every block writes its own rows of medians (numpy releases the GIL while partitioning)
+    with ThreadPoolExecutor(max_workers=nThreads or os.cpu_count()) as executor:
+        list(executor.map(lambda rows: calculateBlockMedian(bandStack[:, :, rows], medians[:, rows]), blocks))
+    return medians
+
+def calculateBlockMedian(block:np.ndarray, medians:np.ndarray) -> np.ndarray:
+    """Calculate the medians of a row block of the band stack
+
+    Pixels are grouped by their number of valid observations n: NODATA is the smallest int16,
+    so the median of a pixel is at the same positions (n from the end of the images) for the
+    whole group, and is selected with a single partition of the group
+
+    Args:
+        block (np.ndarray): row block of the band stack (nImages x nBands x rows x W)
+        medians (np.ndarray): medians of the row block (nBands x rows x W), filled in place
+
+    Returns:
+        np.ndarray: medians of the row block
+    """
+    nImages, nBands, rows, width = block.shape
+    # pixels x bands x images (contiguous images)
+    pixels = np.ascontiguousarray(block.transpose(2, 3, 1, 0)).reshape(rows * width, nBands, nImages)
+    # masks apply to all bands
+    nValid = np.count_nonzero(pixels[:, 0] != NODATA, axis=1)
+    blockMedians = np.zeros((rows * width, nBands), dtype=np.int16)
+    order = np.argsort(nValid, kind='stable')
+    end = np.cumsum(np.bincount(nValid, minlength=nImages + 1))
+    for n in range(1, nImages + 1):
+        group = order[end[n - 1]:end[n]]
+        if len(group) == 0:
+            continue
+        low = nImages - n + (n - 1) // 2
+        high = nImages - n + n // 2
+        values = pixels[group]
+        values.partition(sorted({low, high}), axis=2)
+        summed = values[:, :, low].astype(np.int32) + values[:, :, high]
+        # mean of the two middle values truncated toward zero (as the cast of the float median)
+        blockMedians[group] = (summed + (summed < 0)) // 2
+    medians[:] = blockMedians.T.reshape(nBands, rows, width)
+    return medians
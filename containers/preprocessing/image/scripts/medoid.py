@@ -4,60 +4,36 @@ import time
 import glob
 import logging
 import numpy as np
+from .bandStack import NODATA
+from .median import calculateMedian
 
 gdal.UseExceptions()
 
-def calculateMedoid(inputDir:str, outputDir:str, subTilesDir:str, tile:str, bandList:list, \
-    width:int, height:int, nImages:int, iteration:int, subTile:str, startDateRef:str) -> None:
+def calculateMedoid(outputDir:str, subTilesDir:str, tile:str, bandStack:np.ndarray, \
+    width:int, height:int, nImages:int, iteration:int, subTile:str, startDateRef:str, nThreads:int=None) -> None:
     """Calculate and save median and medoid
 
     Args:
-        inputDir (str): path to directory with masked subtiles (must be created with the maskImages function)
         outputDir (str): path to output directory (output in tif)
         subTilesDir (str): path to directory with resampled subtiles (must be created with the resampleAndSubset function)
         tile (str): tilenumber to process
-        bandList (list): single band arrays # B2, B3, B4, B8, B8A, B9, B11, B12
+        bandStack (np.ndarray): band stack (nImages x nBands x H x W, must be created with the maskImages function) # B2, B3, B4, B8, B8A, B9, B11, B12
         width (int): width of subTile
         height (int): height of subTile
         nImages (int): number of images in stack
         iteration (int): the number of the current iteration (for logging purposes)
         subTile (str): sub-tilenumber to process
         startDateRef (str): start time for logging purposes
+        nThreads (int, optional): number of threads of the median. Defaults to None (number of CPUs).
     """
     os.makedirs(outputDir, exist_ok=True)
     logger = logging.getLogger('{}'.format(startDateRef))
     startTime = time.time()
-    nBands = len(bandList)
-    # init arrays
-    medians = np.zeros((height,width,nBands), dtype=np.uint16)
-    medoid = np.zeros((height,width,nBands), dtype=np.uint16) 
-    summedSquaredDiff = np.zeros((height,width,nImages), dtype=np.uint64)
-    
-    for i, band in enumerate(bandList):
-        if np.all(np.isnan(band)):
-            logger.debug('All nans in band {}, iteration {}'.format(band, i))      
-        medians[:,:,i] = np.nanmedian(band, axis=2)
-
-    if np.all(np.isnan(medians)):  
-        logger.debug('All nans in median for tile {} - sub-tile {}'.format(tile, subTile))     
-        saveEmptyMedoidAndMedian(height=height, width=width, nBands=nBands, outputDir=outputDir, \
-            subTilesDir=subTilesDir, tile=tile, subTile=subTile,startDateRef=startDateRef)
-        return
-
-    bandList = None #Free some memory
-    numpyArrays = glob.glob1(inputDir,"*{}*.npy".format(tile)) 
-    for i, numpyArray in enumerate(numpyArrays):
-        summedSquaredDiff[:,:,i] = calculateSummedSquaredDiff(os.path.join(inputDir, numpyArray), medians, startDateRef)
-    #np.save(os.path.join(outputDir,'summedSquaredDiff_{}_{}.npy'.format(tile, subTile)), summedSquaredDiff)
-    
-    summedSquaredDiff[np.isnan(summedSquaredDiff)] = 99999999999999 if np.all(np.isnan(summedSquaredDiff)) else np.nanmax(summedSquaredDiff)+1 
-    # try:
-    indexMin = np.nanargmin(summedSquaredDiff, axis=2)
-    # except Exception:
-    #     logger.exception('')
+    medians = calculateMedian(bandStack, startDateRef, nThreads=nThreads)
 
-    for i, numpyArray in enumerate(numpyArrays):
-        medoid = getPixelsForMedoid(indexMin, i, medoid, os.path.join(inputDir,numpyArray),startDateRef)
+    summedSquaredDiff = calculateSummedSquaredDiff(bandStack, medians, startDateRef)
+    medoid = getPixelsForMedoid(summedSquaredDiff, bandStack, startDateRef)
+    bandStack = summedSquaredDiff = None #Free some memory
 
     shadowImage = glob.glob1(subTilesDir,"*{}_10m_{}_0.vrt".format(tile, subTile))
     saveAsGTiff(
@@ -65,8 +41,9 @@ def calculateMedoid(inputDir:str, outputDir:str, subTilesDir:str, tile:str, band
         outputFile=os.path.join(outputDir, 'medoid_{}_{}.tif'.format(tile, subTile)), 
         shadowFile=os.path.join(subTilesDir, shadowImage[0]),
         startDateRef=startDateRef)
+    # negative medians wrap around in the uint16 output
     saveAsGTiff(
-        medians, 
+        medians.astype(np.uint16), 
         outputFile=os.path.join(outputDir, 'median_{}_{}.tif'.format(tile, subTile)), 
         shadowFile=os.path.join(subTilesDir, shadowImage[0]),
         startDateRef=startDateRef)
@@ -74,46 +51,46 @@ def calculateMedoid(inputDir:str, outputDir:str, subTilesDir:str, tile:str, band
     # logging
     timeDelta = time.time() - startTime
     logger.info('[{}-B] Calculating medoid for subtile {} completed in {:.2f} seconds. Output files: {}'.format(iteration, subTile,timeDelta, 'medoid_{}_{}.tif and median_{}_{}.tif'.format(tile, subTile, tile, subTile)))
-    summedSquaredDiff = medians = numpyArray = medoid = None #Free some memory
+    medians = medoid = None #Free some memory
 
-def calculateSummedSquaredDiff(file:str, medians:np.ndarray, startDateRef:str) -> np.ndarray:
-    """Calculate the summed squared difference between image and band medians
+def calculateSummedSquaredDiff(bandStack:np.ndarray, medians:np.ndarray, startDateRef:str) -> np.ndarray:
+    """Calculate the summed squared difference between every image and the band medians
 
     Args:
-        file (str): path to image array
-        medians (np.ndarray): array containing median for each band
+        bandStack (np.ndarray): band stack (nImages x nBands x H x W)
+        medians (np.ndarray): array containing median for each band (nBands x H x W)
         startDateRef (str): start time for logging purposes
 
     Returns:
-        np.ndarray: per pixel sum of the squared difference between image and band medians
+        np.ndarray: per image and pixel sum of the squared difference between image and band medians 
+            (nImages x H x W, float32), inf where the image is masked
     """
     logger = logging.getLogger('{}'.format(startDateRef))
-    im = np.load(file)
-    try:
-        squaredDiff = np.power(np.subtract(im, medians), 2)
-    except Exception:
-        logger.exception('Error in file: {}'.format(file))
-        squaredDiff[:] = np.nan
-    return np.sum(squaredDiff,axis=2)
+    medians = medians.astype(np.float32)
+    summedSquaredDiff = np.empty((bandStack.shape[0],) + bandStack.shape[2:], dtype=np.float32)
+    # image by image: temporary arrays have the size of one image
+    for i, bands in enumerate(bandStack):
+        np.sum(np.square(bands - medians), axis=0, out=summedSquaredDiff[i])
+        summedSquaredDiff[i][bands[0] == NODATA] = np.inf # masks apply to all bands
+    return summedSquaredDiff
 
-def getPixelsForMedoid(indexMin:np.ndarray, fileIndex:int, medoid:np.ndarray, file:str, startDateRef:str) -> np.ndarray:
-    """Add medoid pixels from specified image to medoid array
+def getPixelsForMedoid(summedSquaredDiff:np.ndarray, bandStack:np.ndarray, startDateRef:str) -> np.ndarray:
+    """Gather the medoid: per pixel the bands of the image with lowest summed squared difference
 
     Args:
-        indexMin (np.ndarray): index of image with lowest summed squared difference (per pixel)
-        fileIndex (int): index of current image
-        medoid (np.ndarray): medoid array to complement with pixels of current image
-        file (str): path to image array
+        summedSquaredDiff (np.ndarray): summed squared difference of every image (nImages x H x W, inf where masked)
+        bandStack (np.ndarray): band stack (nImages x nBands x H x W)
         startDateRef (str): start time for logging purposes
 
     Returns:
-        np.ndarray: medoid array
+        np.ndarray: medoid array (nBands x H x W, uint16), 0 for pixels without valid observation
     """
     logger = logging.getLogger('{}'.format(startDateRef))
-    im = np.load(file)
-    maskIndex = (indexMin == fileIndex)
-    medoid[maskIndex] = im[maskIndex]
-    return medoid
+    indexMin = np.argmin(summedSquaredDiff, axis=0)[np.newaxis]
+    noObservation = np.isinf(np.take_along_axis(summedSquaredDiff, indexMin, axis=0)[0])
+    medoid = np.take_along_axis(bandStack, indexMin[np.newaxis], axis=0)[0]
+    medoid[:, noObservation] = 0
+    return medoid.astype(np.uint16)
 
 def saveAsGTiff(arr, outputFile, shadowFile,startDateRef:str):
     logger = logging.getLogger('{}'.format(startDateRef))
@@ -122,7 +99,7 @@ def saveAsGTiff(arr, outputFile, shadowFile,startDateRef:str):
     projection = shadow.GetProjection()
     xSize = shadow.RasterXSize
     ySize = shadow.RasterYSize
-    nBands = arr.shape[2]
+    nBands = arr.shape[0]
 
     driver = gdal.GetDriverByName('GTiff')
     outRaster = driver.Create(outputFile, xSize, ySize,nBands,gdal.GDT_UInt16)
@@ -130,7 +107,7 @@ def saveAsGTiff(arr, outputFile, shadowFile,startDateRef:str):
     outRaster.SetProjection(projection)
     for i in range(nBands):
         outBand = outRaster.GetRasterBand(i+1)
-        outBand.WriteArray(arr[:,:,i])
+        outBand.WriteArray(arr[i])
         outBand.FlushCache()
 
 def saveEmptyMedoidAndMedian(height:int, width:int, nBands:int, outputDir:str, \
@@ -148,7 +125,7 @@ def saveEmptyMedoidAndMedian(height:int, width:int, nBands:int, outputDir:str, \
     """
     logger = logging.getLogger('{}'.format(startDateRef))
     os.makedirs(outputDir, exist_ok=True)
-    medoid = np.zeros((height,width,nBands), dtype=np.float32)
+    medoid = np.zeros((nBands,height,width), dtype=np.float32)
     medoid[:] = np.nan
     np.save(os.path.join(outputDir,'medoid_{}_{}.npy'.format(tile, subTile)), medoid)
     shadowImage = glob.glob1(subTilesDir,"*{}_10m_{}_0.vrt".format(tile, subTile))
@@ -3,9 +3,14 @@ import numpy as np
 import glob
 import os
 import logging
+import logging.handlers
+import multiprocessing
 import shutil
+import psutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from .resampleAndSubset import resampleAndSubset
-from .masking import maskImages
+from .masking import maskImages, getSubTileSize
+from .bandStack import estimateBandStackMemory
 from .medoid import calculateMedoid
 from .mergeSubtiles import mergeSubTiles, mergeTilesToEPSGCode
 from .regionMapping import regionMapping
@@ -47,6 +52,12 @@ def executePreprocessing(region: str, config, startDateRef: str, startDate: str,
     os.makedirs(outDir, exist_ok=True)
 
     NBANDS = 8  # (B2, B3, B4, B8, B8A, B9, B11, B12)
+    bandStackRam = int(config.getfloat('preprocessing', 'BANDSTACKRAM', fallback=0) * 2**30)
+    nWorkers = config.getint('preprocessing', 'WORKERS', fallback=0) or os.cpu_count()
+    memoryBudget = int(config.getfloat('preprocessing', 'MEMORY', fallback=0) * 2**30) or \
+        int(psutil.virtual_memory().available * 0.75)
+    # the subtile grid of every tile is adapted so that every worker has a subtile that fits in its memory
+    subTileMemory = memoryBudget // nWorkers
 
     for tile in tiles:
         assert os.path.exists(os.path.join(geojsonDir, '{}_{}.geojson'.format(tile, region))), \
@@ -56,28 +67,26 @@ def executePreprocessing(region: str, config, startDateRef: str, startDate: str,
             dataDir, tile)), 'Input directory {} does not exists'.format(os.path.join(dataDir, tile))
         assert len(glob.glob(dataDir+'/{}/*'.format(tile))
                    ) > 0, 'Input directory {} is empty'.format(os.path.join(dataDir, tile))
+    subTileTasks = [] # (tile, subTile, nImages)
     for tile in tiles:
         cropFile = os.path.join(
             geojsonDir, '{}_{}.geojson'.format(tile, region))
         nImages = resampleAndSubset(inputDir=os.path.join(dataDir, tile), resampleDir=resampleDir, subTilesDir=subTilesDir,
-                                    tile=tile, cropFile=cropFile, startDateRef=startDateRef)
+                                    tile=tile, cropFile=cropFile, startDateRef=startDateRef, nBands=NBANDS,
+                                    subTileMemory=subTileMemory, minSubTiles=nWorkers, ramBudget=bandStackRam)
         resampledFiles = glob.glob(subTilesDir+'/*_{}_*'.format(tile))
         subTiles = np.array([os.path.basename(file).split(
             '_')[3].split('.')[0] for file in resampledFiles])
         uniqueSubTiles = set(subTiles)
-        for i_subTile, subTile in enumerate(uniqueSubTiles):
-            bandList, width, height = maskImages(inputDir=subTilesDir, outputDir=maskedDir, tile=tile, subTile=subTile,
-                                                 iteration=i_subTile, nImages=nImages, nBands=NBANDS, compositDir=compositDir, startDateRef=startDateRef)
-            if len(bandList) > 0:
-                calculateMedoid(inputDir=maskedDir, outputDir=compositDir, subTilesDir=subTilesDir, tile=tile,
-                                bandList=bandList, width=width, height=height, nImages=nImages, iteration=i_subTile,
-                                subTile=subTile, startDateRef=startDateRef)
-        mergeSubTiles(inputDir=compositDir, outputDir=mergedCompositDir,
-                      tile=tile, startDateRef=startDateRef)
-        # Delete temporary files (and folder) of intermediate steps
-        #shutil.rmtree(subTilesDir)
-        #shutil.rmtree(maskedDir) 
-        #shutil.rmtree(resampleDir)
+        subTileTasks += [(tile, subTile, nImages) for subTile in sorted(uniqueSubTiles)]
+    # subtiles of all tiles are masked and composited in parallel, every tile is merged when its subtiles are done
+    processSubTiles(subTileTasks=subTileTasks, subTilesDir=subTilesDir, maskedDir=maskedDir, compositDir=compositDir,
+                    mergedCompositDir=mergedCompositDir, nBands=NBANDS, startDateRef=startDateRef, ramBudget=bandStackRam,
+                    nWorkers=nWorkers, memoryBudget=memoryBudget)
+    # Delete temporary files (and folder) of intermediate steps
+    #shutil.rmtree(subTilesDir)
+    #shutil.rmtree(maskedDir) 
+    #shutil.rmtree(resampleDir)
     mergeTilesToEPSGCode(inputDir=mergedCompositDir,
                     outputDir=regionDir, startDateRef=startDateRef)
     tif2netcdf(
@@ -116,3 +125,95 @@ def executePreprocessing(region: str, config, startDateRef: str, startDate: str,
     #shutil.rmtree(dataDir)
     #shutil.rmtree(regionDir)
     #shutil.rmtree(workDir, ignore_errors=True)
+
+def processSubTiles(subTileTasks:list, subTilesDir:str, maskedDir:str, compositDir:str, mergedCompositDir:str, \
+    nBands:int, startDateRef:str, ramBudget:int, nWorkers:int, memoryBudget:int) -> None:
+    """Mask and composite subtiles in a pool of worker processes, merge the subtiles of every tile when they are done
+
+    Args:
+        subTileTasks (list): subtiles to process (tile, subTile, nImages)
+        subTilesDir (str): path to directory with resampled subtiles (must be created with the resampleAndSubset function)
+        maskedDir (str): path to the directory of the band stack spill files
+        compositDir (str): path to the directory where the medoids of the subtiles are saved (one directory per tile)
+        mergedCompositDir (str): path to the directory where the medoids of the tiles are saved
+        nBands (int): number of bands to process
+        startDateRef (str): start time for logging purposes
+        ramBudget (int): maximum size (bytes) of a band stack held in memory (0: no limit)
+        nWorkers (int): maximum number of worker processes
+        memoryBudget (int): memory (bytes) available to the worker processes
+    """
+    logger = logging.getLogger('{}'.format(startDateRef))
+    # the number of workers is bounded by the memory needed by the largest subtile
+    subTileMemory = max(estimateBandStackMemory(*getSubTileSize(subTilesDir, tile, subTile), nImages=nImages, \
+        nBands=nBands, ramBudget=ramBudget) for tile, subTile, nImages in subTileTasks)
+    nWorkers = max(min(nWorkers, len(subTileTasks), memoryBudget // subTileMemory), 1)
+    nThreads = max(os.cpu_count() // nWorkers, 1)
+    logger.info('#### Processing {} subtiles with {} workers ({:.1f} GB per subtile) ####'.format(
+        len(subTileTasks), nWorkers, subTileMemory / 2**30))
+
+    remainingSubTiles = {tile: 0 for tile, _, _ in subTileTasks}
+    for tile, _, _ in subTileTasks:
+        remainingSubTiles[tile] += 1
+    # spawned workers: the log records are handled by the handlers of the logger of this process
+    context = multiprocessing.get_context('spawn')
+    logQueue = context.Queue()
+    logListener = logging.handlers.QueueListener(logQueue, *logger.handlers, respect_handler_level=True)
+    logListener.start()
+    try:
+        with ProcessPoolExecutor(max_workers=nWorkers, mp_context=context, initializer=initSubTileWorker, \
+            initargs=(startDateRef, logQueue)) as executor:
+            futures = {}
+            for iteration, (tile, subTile, nImages) in enumerate(subTileTasks):
+                future = executor.submit(processSubTile, subTilesDir=subTilesDir, maskedDir=maskedDir, \
+                    compositDir=os.path.join(compositDir, tile), tile=tile, subTile=subTile, \
+                    iteration=iteration, nImages=nImages, nBands=nBands, startDateRef=startDateRef, \
+                    ramBudget=ramBudget, nThreads=nThreads)
+                futures[future] = tile
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    # subtiles not started yet are cancelled
+                    executor.shutdown(cancel_futures=True)
+                    raise future.exception()
+                tile = futures[future]
+                remainingSubTiles[tile] -= 1
+                if remainingSubTiles[tile] == 0:
+                    mergeSubTiles(inputDir=os.path.join(compositDir, tile), outputDir=mergedCompositDir,
+                                  tile=tile, startDateRef=startDateRef)
+    finally:
+        logListener.stop()
+
+def initSubTileWorker(startDateRef:str, logQueue) -> None:
+    """Initialize a subtile worker process: log records are sent to the main process
+
+    Args:
+        startDateRef (str): start time for logging purposes
+        logQueue (multiprocessing.Queue): queue of the log records
+    """
+    logger = logging.getLogger('{}'.format(startDateRef))
+    logger.addHandler(logging.handlers.QueueHandler(logQueue))
+    logger.setLevel(logging.INFO)
+
+def processSubTile(subTilesDir:str, maskedDir:str, compositDir:str, tile:str, subTile:str, iteration:int, \
+    nImages:int, nBands:int, startDateRef:str, ramBudget:int, nThreads:int) -> None:
+    """Mask the images of a subtile and calculate its medoid and median (in a worker process)
+
+    Args:
+        subTilesDir (str): path to directory with resampled subtiles (must be created with the resampleAndSubset function)
+        maskedDir (str): path to the directory of the band stack spill files
+        compositDir (str): path to the directory where the medoids of the subtiles of the tile are saved
+        tile (str): tilenumber to process
+        subTile (str): sub-tilenumber to process
+        iteration (int): the number of the current iteration (for logging purposes)
+        nImages (int): number of images of the tile
+        nBands (int): number of bands to process
+        startDateRef (str): start time for logging purposes
+        ramBudget (int): maximum size (bytes) of a band stack held in memory (0: no limit)
+        nThreads (int): number of threads of the median
+    """
+    bandStack, width, height = maskImages(inputDir=subTilesDir, outputDir=maskedDir, tile=tile, subTile=subTile,
+                                          iteration=iteration, nImages=nImages, nBands=nBands, compositDir=compositDir,
+                                          startDateRef=startDateRef, ramBudget=ramBudget)
+    if bandStack is not None:
+        calculateMedoid(outputDir=compositDir, subTilesDir=subTilesDir, tile=tile, bandStack=bandStack, width=width,
+                        height=height, nImages=nImages, iteration=iteration, subTile=subTile, startDateRef=startDateRef,
+                        nThreads=nThreads)
@@ -5,10 +5,12 @@ import time
 import logging
 from typing import Tuple
 from math import floor
+from .bandStack import estimateBandStackMemory
 
 gdal.UseExceptions()
 
-def resampleAndSubset(inputDir:str, resampleDir:str, subTilesDir:str, tile:str, cropFile:str, startDateRef:str) -> int:
+def resampleAndSubset(inputDir:str, resampleDir:str, subTilesDir:str, tile:str, cropFile:str, startDateRef:str, \
+    nBands:int=8, subTileMemory:int=0, minSubTiles:int=1, ramBudget:int=0) -> int:
     """Resample input bands to 10m, crop to cutline and create sub-tiles for processing
 
     Args:
@@ -18,6 +20,10 @@ def resampleAndSubset(inputDir:str, resampleDir:str, subTilesDir:str, tile:str,
         tile (str): tilenumber to process
         cropFile (str): path to file to use as cutline for cropping
         startDateRef (str): start time for logging purposes
+        nBands (int, optional): number of bands masked and composited. Defaults to 8.
+        subTileMemory (int, optional): memory (bytes) to mask and composite a sub-tile. Defaults to 0 (no limit).
+        minSubTiles (int, optional): minimum number of sub-tiles. Defaults to 1.
+        ramBudget (int, optional): maximum size (bytes) of a band stack held in memory. Defaults to 0 (no limit).
 
     Returns:
         int: number of source files processed
@@ -35,7 +41,8 @@ def resampleAndSubset(inputDir:str, resampleDir:str, subTilesDir:str, tile:str,
         startTime = time.time()
         sensingDate, width, height, xMin, yMin, xMax, yMax, xSizes, ySizes, xCoords, yCoords = \
             resample(resampleDir, tile, file, cropFile, width, height, xMin, yMin, xMax, yMax, \
-            xSizes, ySizes, xCoords, yCoords, iteration=i, startDateRef=startDateRef)
+            xSizes, ySizes, xCoords, yCoords, iteration=i, startDateRef=startDateRef, nImages=nImages, nBands=nBands, \
+            subTileMemory=subTileMemory, minSubTiles=minSubTiles, ramBudget=ramBudget)
         timeDelta = time.time() - startTime
         logger.info('[{}-A] Resampling and cropping file {} completed in {:.2f} seconds.'.format(i, os.path.basename(file),timeDelta))
 
@@ -54,7 +61,8 @@ def resampleAndSubset(inputDir:str, resampleDir:str, subTilesDir:str, tile:str,
 def resample(outputDir:str, tile:str, file:str, cropFile:str, width:int or None, height:int or None, \
     xMin:float or None, yMin:float or None, xMax:float or None, yMax:float or None, \
     xSizes:list or None, ySizes:list or None, xCoords:list or None, yCoords:list or None, \
-    iteration:int,startDateRef:str) -> Tuple[str, int, int, float, float, float, float, list, list, list, list]:
+    iteration:int,startDateRef:str, nImages:int, nBands:int, subTileMemory:int, minSubTiles:int, ramBudget:int) \
+    -> Tuple[str, int, int, float, float, float, float, list, list, list, list]:
     """Resample input bands to 10m
 
     Args:
@@ -74,6 +82,11 @@ def resample(outputDir:str, tile:str, file:str, cropFile:str, width:int or None,
         yCoords (list | None): y-coords of subTiles to create, None on first interation 
         iteration (int): current iteration to avoid overwriting files
         startDateRef (str): start time for logging purposes
+        nImages (int): number of source files of the tile
+        nBands (int): number of bands masked and composited
+        subTileMemory (int): memory (bytes) to mask and composite a sub-tile (0: no limit)
+        minSubTiles (int): minimum number of sub-tiles
+        ramBudget (int): maximum size (bytes) of a band stack held in memory (0: no limit)
 
     Returns:
         str: sensing date of source image 
@@ -101,8 +114,9 @@ def resample(outputDir:str, tile:str, file:str, cropFile:str, width:int or None,
         ds10, cropToCutline=True, cutlineDSName=cropFile, dstNodata=0)
     if width == None:
         width, height, xMin, yMin, xMax, yMax, xSizes, ySizes, xCoords, yCoords = \
-            getOutputBounds(outputDir, tile=tile, date=sensingDate, \
-            iteration=iteration, startDateRef=startDateRef)
+            getOutputBounds(outputDir, tile=tile, date=sensingDate, startDateRef=startDateRef, \
+            nImages=nImages, nBands=nBands, subTileMemory=subTileMemory, minSubTiles=minSubTiles, \
+            ramBudget=ramBudget, iteration=iteration)
     gdal.Warp(os.path.join(outputDir,'{}_{}_20m_{}.tif'.format(sensingDate, tile, iteration)), \
         ds20, cropToCutline=True, cutlineDSName=cropFile, dstNodata=0, resampleAlg='near', \
         outputBounds=(xMin, yMin, xMax, yMax), width=width, height=height)
@@ -156,17 +170,21 @@ def deleteTemporaryResampledFiles(inputDir:str, date:str, tile:str, iteration:in
     os.remove(os.path.join(inputDir,'{}_{}_20m_{}.tif'.format(date, tile,iteration)))
     os.remove(os.path.join(inputDir,'{}_{}_60m_{}.tif'.format(date, tile,iteration)))
 
-def getOutputBounds(inputDir:str, tile:str, date:str, startDateRef:str, nTilesX:int=3, nTilesY:int=3,\
+def getOutputBounds(inputDir:str, tile:str, date:str, startDateRef:str, nImages:int, nBands:int=8, \
+        subTileMemory:int=0, minSubTiles:int=1, ramBudget:int=0, \
         iteration:int=0) -> Tuple[int, int, float, float, float, float, list, list, list, list]:
-    """_summary_
+    """Get the bounds of the tile and of its subtiles (grid adapted to the memory needed by the subtiles)
 
     Args:
         inputDir (str): path to directory with resampled tiles (must be created with the resample function)
         tile (str): tilenumber to process
         date (str): generation date of image (only for saving purposes) 
         startDateRef (str): start time for logging purposes
-        nTilesX (int, optional): number of subtiles to create in the x-direction. Defaults to 3.
-        nTilesY (int, optional): number of subtiles to create in the y-direction. Defaults to 3.
+        nImages (int): number of source files of the tile
+        nBands (int, optional): number of bands masked and composited. Defaults to 8.
+        subTileMemory (int, optional): memory (bytes) to mask and composite a sub-tile. Defaults to 0 (no limit).
+        minSubTiles (int, optional): minimum number of sub-tiles. Defaults to 1.
+        ramBudget (int, optional): maximum size (bytes) of a band stack held in memory. Defaults to 0 (no limit).
         iteration (int, optional): iteration used as extra identiefier file. Defaults to 0.
     Returns:
         int: width 
@@ -192,6 +210,9 @@ def getOutputBounds(inputDir:str, tile:str, date:str, startDateRef:str, nTilesX:
     yMin = yMax + geoTransform[5]*height 
     res = geoTransform[1]
 
+    nTilesX = nTilesY = getSubTileGrid(width, height, nImages=nImages, nBands=nBands, subTileMemory=subTileMemory, \
+        minSubTiles=minSubTiles, ramBudget=ramBudget)
+    logger.info('Tile {} split in {}x{} subtiles ({} images)'.format(tile, nTilesX, nTilesY, nImages))
     tileWidth = floor(width / nTilesX)
     tileHeight = floor(height / nTilesY)
     lastWidth = (width % nTilesX) + tileWidth
@@ -207,3 +228,31 @@ def getOutputBounds(inputDir:str, tile:str, date:str, startDateRef:str, nTilesX:
     ySizes.append(lastHeight)
     return width, height, xMin, yMin, xMax, yMax, xSizes, ySizes, xCoords, yCoords
 
+def getSubTileGrid(width:int, height:int, nImages:int, nBands:int, subTileMemory:int, minSubTiles:int=1, \
+        ramBudget:int=0) -> int:
+    """Get the number of subtiles in the x- and y-direction: the smallest grid with at least minSubTiles
+    subtiles whose largest subtile can be masked and composited within subTileMemory
+
+    Args:
+        width (int): width of the tile
+        height (int): height of the tile
+        nImages (int): number of source files of the tile
+        nBands (int): number of bands masked and composited
+        subTileMemory (int): memory (bytes) to mask and composite a sub-tile (0: no limit)
+        minSubTiles (int, optional): minimum number of sub-tiles. Defaults to 1.
+        ramBudget (int, optional): maximum size (bytes) of a band stack held in memory. Defaults to 0 (no limit).
+
+    Returns:
+        int: number of subtiles in the x- and y-direction
+    """
+    nTiles = 1
+    while nTiles < min(width, height):
+        # the last subtile in each direction is the largest
+        subTileWidth = floor(width / nTiles) + width % nTiles
+        subTileHeight = floor(height / nTiles) + height % nTiles
+        subTileFits = not subTileMemory or \
+            estimateBandStackMemory(subTileWidth, subTileHeight, nImages, nBands, ramBudget) <= subTileMemory
+        if subTileFits and nTiles**2 >= minSubTiles:
+            break
+        nTiles += 1
+    return nTiles